@@ -1,87 +1,369 @@
+import abc
 import json
 import os
 import re
-
-from tqdm import tqdm
+from functools import partial
+from typing import Dict, Iterable, Optional, List, Tuple
 
 import utils.paths as paths
+from utils.dedup import IdDeduplicator
+from utils.file_utils import read_jsonl_lines
+from utils.parallel import map_ordered
+from utils.tweet_index import TweetIndex
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class BotFilter:
+    """
+    Bot rules of bots_content.json compiled once. All regexes are tried at the
+    start of the text through a single compiled alternation, and, with substring,
+    each of them is also looked up as a literal in the lowered text, through an
+    Aho-Corasick automaton when pyahocorasick is installed
+    """
+
+    def __init__(
+            self,
+            regexes: Iterable[str],
+            user_ids: Iterable[str],
+            ignore_case: Optional[bool] = True,
+            substring: Optional[bool] = True):
+        self.regexes = list(regexes)
+        self.user_ids = set(user_ids)
+        flags = re.I if ignore_case else 0
+        self._start_patterns = []
+        if self.regexes:
+            try:
+                self._start_patterns = [(None, re.compile(
+                    '|'.join(f'(?P<rule{index}>{regex})' for index, regex in enumerate(self.regexes)),
+                    flags))]
+            except re.error:
+                # a regex with backreferences or global flags can not be merged with the
+                # others, nor wrapped in a named group, each one is compiled as is
+                self._start_patterns = [(index, re.compile(regex, flags))
+                                        for index, regex in enumerate(self.regexes)]
+        self._literal_automaton = None
+        self._literal_pattern = None
+        if substring and self.regexes:
+            if ahocorasick:
+                self._literal_automaton = ahocorasick.Automaton()
+                for index, regex in enumerate(self.regexes):
+                    self._literal_automaton.add_word(regex, index)
+                self._literal_automaton.make_automaton()
+            else:
+                self._literal_pattern = re.compile(
+                    '|'.join(re.escape(regex) for regex in self.regexes))
+
+    @classmethod
+    def from_json(cls, bots_json_path: str, **kwargs) -> 'BotFilter':
+        with open(bots_json_path, 'r') as bots_json_file:
+            bots_json = json.loads(bots_json_file.read())
+        return cls(
+            regexes=bots_json.get('bots_regexes', []),
+            user_ids=bots_json.get('bots_user_ids', []),
+            **kwargs
+        )
+
+    def match_text(self, text: str) -> Optional[str]:
+        """
+        Name of the rule matching the text of a tweet, None if no rule matches
+        """
+        for index, pattern in self._start_patterns:
+            match = pattern.match(text)
+            if match:
+                if index is None:
+                    index = match.lastgroup[len('rule'):]
+                return f'bots_regexes[{index}] (match)'
+        if self._literal_automaton:
+            for _, index in self._literal_automaton.iter(text.lower()):
+                return f'bots_regexes[{index}] (substring)'
+        elif self._literal_pattern:
+            match = self._literal_pattern.search(text.lower())
+            if match:
+                return f'bots_regexes[{self.regexes.index(match.group())}] (substring)'
+        return None
+
+    def match_rule(self, tweet: Dict) -> Optional[str]:
+        """
+        Name of the rule flagging the tweet as coming from a bot, None for a regular tweet
+        """
+        if tweet.get('author_id') in self.user_ids:
+            return 'bots_user_ids'
+        return self.match_text(tweet.get('text') or '')
+
+
+class CleaningStage(abc.ABC):
+    """
+    One filter of the cleaning pipeline. check() returns None to keep a tweet,
+    or the reason why it is dropped. fields lists the tweet keys the stage reads
+    """
+    name = 'stage'
+    fields = ()
+
+    def start_file(self, file_name: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def check(self, tweet: Dict) -> Optional[str]:
+        pass
+
+
+class LanguageStage(CleaningStage):
+    name = 'language'
+    fields = ('lang',)
+
+    def __init__(self, language: str):
+        self.language = language
+
+    def check(self, tweet: Dict) -> Optional[str]:
+        if tweet.get('lang') != self.language:
+            return self.name
+        return None
+
+
+class BotTextStage(CleaningStage):
+    name = 'bots_text'
+    fields = ('text',)
+
+    def __init__(self, bot_filter: BotFilter):
+        self.bot_filter = bot_filter
+
+    def check(self, tweet: Dict) -> Optional[str]:
+        return self.bot_filter.match_text(tweet.get('text') or '')
+
+
+class BotIdStage(CleaningStage):
+    name = 'bots_user_ids'
+    fields = ('author_id',)
+
+    def __init__(self, user_ids: Iterable[str]):
+        self.user_ids = set(user_ids)
+
+    def check(self, tweet: Dict) -> Optional[str]:
+        if tweet.get('author_id') in self.user_ids:
+            return self.name
+        return None
+
 
+class DedupStage(CleaningStage):
+    """
+    Drops ids already kept earlier in the file, ids kept in a previous file are
+    dropped afterwards by run_cleaning_stages. Must be the last stage, so that
+    only the ids of written tweets are recorded
+    """
+    name = 'duplicates'
+    fields = ('id',)
 
-def remove_doubles(input_dir: str, output_dir: str, language_filter=None) -> None:
-    for file_name in os.listdir(input_dir):
-        if file_name.endswith('.jsonl'):
-            file_ids = []
-            with open(os.path.join(input_dir, file_name), 'r') as input_file, \
-                    open(os.path.join(output_dir, file_name), 'w') as output_file:
-                for line in tqdm(input_file.readlines()):
-                    tweet = json.loads(line)
-                    tweet_id = tweet.get('id')
-                    tweet_lang = tweet.get('lang')
-                    if (tweet_id not in file_ids) and \
-                            (not language_filter or tweet_lang == language_filter):
-                        output_file.write(line)
-                        file_ids.append(tweet_id)
+    def __init__(self):
+        self.deduplicator = IdDeduplicator()
 
+    def start_file(self, file_name: str) -> None:
+        self.deduplicator = IdDeduplicator()
 
-def remove_bots_messages(input_dir: str, output_dir: str, bots_json_path: str) -> None:
+    def check(self, tweet: Dict) -> Optional[str]:
+        if self.deduplicator.is_duplicate(tweet.get('id')):
+            return self.name
+        return None
+
+
+def list_jsonl_files(input_dir: str) -> List[str]:
+    return sorted(file_name for file_name in os.listdir(input_dir) if file_name.endswith('.jsonl'))
+
+
+def _run_stages_on_file(
+        file_name: str,
+        input_dir: str,
+        output_dir: str,
+        stages: List[CleaningStage],
+        progress: bool,
+        track_lines: bool) -> Tuple[Dict[str, Dict[str, int]], Optional[List[Tuple]]]:
+    """
+    Worker of run_cleaning_stages: a single streaming pass over one file, kept
+    lines are written as read, without being serialized again.
+    Returns the drop counts per stage and reason, and, with track_lines, the
+    (id, byte length) of the written lines
+    """
+    fields = sorted({'id'}.union(*[stage.fields for stage in stages]))
+    for stage in stages:
+        stage.start_file(file_name)
+    kept_lines = [] if track_lines else None
+    counts = {stage.name: {} for stage in stages}
+    with open(os.path.join(output_dir, file_name), 'w', encoding='utf-8') as output_file:
+        for line, tweet in read_jsonl_lines(
+                os.path.join(input_dir, file_name),
+                progress=progress,
+                fields=fields):
+            for stage in stages:
+                reason = stage.check(tweet)
+                if reason:
+                    counts[stage.name][reason] = counts[stage.name].get(reason, 0) + 1
+                    break
+            else:
+                output_file.write(line)
+                if track_lines:
+                    kept_lines.append((tweet.get('id'), len(line.encode('utf-8'))))
+    return counts, kept_lines
+
+
+def _line_offsets(kept_lines: List[Tuple]) -> Iterable[Tuple]:
+    """
+    (id, offset, length) of consecutive lines from their (id, length)
+    """
+    offset = 0
+    for tweet_id, length in kept_lines:
+        yield tweet_id, offset, length
+        offset += length
+
+
+def _drop_lines(file_path: str, keep_mask: List[bool]) -> None:
+    temp_path = f'{file_path}.tmp'
+    # binary lines are copied unchanged (CRLF included) so that the byte
+    # offsets recorded for the kept lines stay valid
+    with open(file_path, 'rb') as input_file, open(temp_path, 'wb') as output_file:
+        for line, keep in zip(input_file, keep_mask):
+            if keep:
+                output_file.write(line)
+    os.replace(temp_path, file_path)
+
+
+def run_cleaning_stages(
+        input_dir: str,
+        output_dir: str,
+        stages: List[CleaningStage],
+        num_workers: int = 1,
+        dedup_index_path: str = None,
+        tweet_index_path: str = None) -> Dict[str, Dict[str, int]]:
+    """
+    Run a list of stages over every month file of input_dir in one streaming
+    pass per file (files in parallel with num_workers > 1), and print the number
+    of tweets dropped by each stage. With a final DedupStage, ids already kept in
+    a previous file are then dropped, so that the output is the same as a serial
+    pass over the files in name order.
+    With tweet_index_path, the byte offsets of the written tweets are recorded
+    in a TweetIndex of the output files
+    """
+    if any(isinstance(stage, DedupStage) for stage in stages[:-1]):
+        raise ValueError('DedupStage must be the last cleaning stage')
+    deduplicate = bool(stages) and isinstance(stages[-1], DedupStage)
+    file_names = list_jsonl_files(input_dir)
+    results = map_ordered(
+        partial(
+            _run_stages_on_file,
+            input_dir=input_dir,
+            output_dir=output_dir,
+            stages=stages,
+            progress=num_workers <= 1,
+            track_lines=deduplicate or bool(tweet_index_path)),
+        file_names,
+        num_workers
+    )
+    total_counts = {stage.name: {} for stage in stages}
+    deduplicator = IdDeduplicator(index_path=dedup_index_path)
+    tweet_index = TweetIndex(tweet_index_path) if tweet_index_path else None
+    for file_name, (counts, kept_lines) in zip(file_names, results):
+        if deduplicate:
+            keep_mask = deduplicator.keep_mask([tweet_id for tweet_id, _ in kept_lines])
+            if not all(keep_mask):
+                _drop_lines(os.path.join(output_dir, file_name), keep_mask)
+                kept_lines = [kept_line for kept_line, keep in zip(kept_lines, keep_mask) if keep]
+                dedup_name = stages[-1].name
+                counts[dedup_name][dedup_name] = \
+                    counts[dedup_name].get(dedup_name, 0) + keep_mask.count(False)
+        if tweet_index is not None:
+            tweet_index.add_file_entries(
+                os.path.join(output_dir, file_name), _line_offsets(kept_lines))
+        file_removed = sum(sum(reasons.values()) for reasons in counts.values())
+        print(f"{file_name} : removed {file_removed} tweets")
+        for stage_name, reasons in counts.items():
+            for reason, count in reasons.items():
+                total_counts[stage_name][reason] = total_counts[stage_name].get(reason, 0) + count
+    deduplicator.close()
+    if tweet_index is not None:
+        tweet_index.close()
+    for stage_name, reasons in total_counts.items():
+        print(f"{stage_name} removed {sum(reasons.values())} tweets")
+        for reason, count in sorted(reasons.items()):
+            if reason != stage_name:
+                print(f"    {reason} : {count}")
+    print(f"Removed {sum(sum(reasons.values()) for reasons in total_counts.values())} tweets in total")
+    return total_counts
+
+
+def remove_doubles(
+        input_dir: str,
+        output_dir: str,
+        language_filter=None,
+        dedup_index_path: str = None,
+        num_workers: int = 1) -> None:
+    stages = [LanguageStage(language_filter)] if language_filter else []
+    run_cleaning_stages(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        stages=stages + [DedupStage()],
+        num_workers=num_workers,
+        dedup_index_path=dedup_index_path
+    )
+
+
+def remove_bots_messages(
+        input_dir: str,
+        output_dir: str,
+        bots_json_path: str,
+        num_workers: int = 1) -> None:
     with open(bots_json_path, 'r') as bots_json_file:
         regexes = json.loads(bots_json_file.read()).get('bots_regexes')
-    for file_name in os.listdir(input_dir):
-        if file_name.endswith('.jsonl'):
-            with open(os.path.join(input_dir, file_name), 'r') as input_file, \
-                    open(os.path.join(output_dir, file_name), 'w') as output_file:
-                for line in tqdm(input_file.readlines()):
-                    tweet = json.loads(line)
-                    tweet_text = tweet.get('text')
-                    if not any([re.match(regex, tweet_text) for regex in regexes]):
-                        output_file.write(line)
-
-
-def remove_bots_ids(input_dir: str, output_dir: str, bots_json_path: str) -> None:
-    counter = 0
+    run_cleaning_stages(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        stages=[BotTextStage(BotFilter(regexes, [], ignore_case=False, substring=False))],
+        num_workers=num_workers
+    )
+
+
+def remove_bots_ids(
+        input_dir: str,
+        output_dir: str,
+        bots_json_path: str,
+        num_workers: int = 1) -> None:
     with open(bots_json_path, 'r') as bots_json_file:
         bots_user_ids = json.loads(bots_json_file.read()).get('bots_user_ids')
-    for file_name in os.listdir(input_dir):
-        if file_name.endswith('.jsonl'):
-            with open(os.path.join(input_dir, file_name), 'r') as input_file, \
-                    open(os.path.join(output_dir, file_name), 'w') as output_file:
-                for line in tqdm(input_file.readlines()):
-                    tweet = json.loads(line)
-                    author_id = tweet.get('author_id')
-                    if author_id not in bots_user_ids:
-                        output_file.write(line)
-                    else:
-                        counter += 1
+    run_cleaning_stages(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        stages=[BotIdStage(bots_user_ids)],
+        num_workers=num_workers
+    )
 
 
 def full_cleaning_pipeline(input_dir: str,
                            output_dir: str,
                            bots_json_path: str,
-                           language_filter: str = None):
-    counter = 0
-    with open(bots_json_path, 'r') as bots_json_file:
-        bots_json = json.loads(bots_json_file.read())
-        bots_user_ids = bots_json.get('bots_user_ids')
-        regexes = bots_json.get('bots_regexes')
-    for file_name in os.listdir(input_dir):
-        if file_name.endswith('.jsonl'):
-            with open(os.path.join(input_dir, file_name), 'r') as input_file, \
-                    open(os.path.join(output_dir, file_name), 'w') as output_file:
-                for line in tqdm(input_file.readlines()):
-                    tweet = json.loads(line)
-                    tweet_lang = tweet.get('lang')
-                    tweet_text = tweet.get('text')
-                    author_id = tweet.get('author_id')
-                    if (not language_filter or tweet_lang == language_filter) \
-                            and not any([re.match(regex, tweet_text, flags=re.I) for regex in regexes])\
-                            and not any([regex in tweet_text.lower() for regex in regexes])\
-                            and author_id not in bots_user_ids:
-                        output_file.write(line)
-                    else:
-                        counter += 1
-    print(f"Removed {counter} tweets in total")
-
-                        
+                           language_filter: str = None,
+                           remove_duplicates: bool = False,
+                           num_workers: int = 1,
+                           tweet_index_path: str = None,
+                           dedup_index_path: str = None):
+    bot_filter = BotFilter.from_json(bots_json_path)
+    stages = [LanguageStage(language_filter)] if language_filter else []
+    stages.extend([
+        BotTextStage(bot_filter),
+        BotIdStage(bot_filter.user_ids)
+    ])
+    if remove_duplicates:
+        stages.append(DedupStage())
+    run_cleaning_stages(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        stages=stages,
+        num_workers=num_workers,
+        tweet_index_path=tweet_index_path,
+        dedup_index_path=dedup_index_path
+    )
+
+
 if __name__ == "__main__":
     
     full_cleaning_pipeline(
@@ -2,11 +2,17 @@ import json
 import os
 import re
 import sys
+import time
+from functools import partial
+from typing import Dict
 
 sys.path.append('/home/juliette/projects/search-tweets-python')
 from searchtweets import gen_request_parameters, load_credentials, ResultStream
 
-from utils.file_utils import read_jsonl_generator
+from utils.dedup import IdDeduplicator
+from utils.file_utils import read_jsonl_generator, json_dumps, drop_partial_last_line
+from utils.parallel import map_ordered
+from utils.rate_limit import RateLimitGovernor, RequestBudget
 import utils.paths as paths
 
 
@@ -100,7 +106,20 @@ def make_output_dir(output_path: str, query_name: str):
     return output_dir
 
 
-def write_year_of_tweets(output_path, query_dict):
+def write_year_of_tweets(
+        output_path,
+        query_dict,
+        stream_factory=create_stream,
+        num_windows: int = 1,
+        max_requests: int = None,
+        max_tweets: int = None,
+        requests_per_window: int = None):
+    """
+    Harvest every month window of a query into its own jsonl file, with up to
+    num_windows months harvested at once. All windows share one request/tweet
+    budget and one rate limit governor (requests_per_window per 15 minutes),
+    a window stopped by the budget keeps its checkpoint and resumes on the next run
+    """
     query_string = query_dict.get("query")
     year = make_year_from_start_end(
         start=query_dict.get('start'),
@@ -108,60 +127,169 @@ def write_year_of_tweets(output_path, query_dict):
     search_args = load_credentials("~/.twitter_keys.yaml",
                                    yaml_key="search_tweets_api",
                                    env_overwrite=False)
-    for month_tuple in year:
-        print(f"Retrieving tweets from {month_tuple[0]} to {month_tuple[1]}")
-        query = create_request(
-            query_string,
-            start_date=month_tuple[0],
-            end_date=month_tuple[1]
+    windows = [
+        (
+            os.path.join(output_path, f"{month_tuple[0]}---{month_tuple[1]}.jsonl"),
+            create_request(
+                query_string,
+                start_date=month_tuple[0],
+                end_date=month_tuple[1]
+            )
         )
-        stream_search = create_stream(query, search_args)
-        file_path = os.path.join(output_path, f"{month_tuple[0]}---{month_tuple[1]}.jsonl")
-        if os.path.exists(file_path):
-            update_existing_file(file_path, stream_search)
-        else:
-            write_new_file(file_path, stream_search)
-
-
-def update_existing_file(file_path: str, stream_search):
-    done_ids = []
-    for tweet in read_jsonl_generator(file_path):
-        done_ids.append(tweet.get('id'))
-    page_number = 0
-    new_tweets_counter = 0
-    with open(file_path, 'a') as jsonl_file:
-        for page in stream_search.stream():
-            items_number = page.get('meta').get('result_count')
-            page_number += 1
-            print(f"page n°{page_number} with {items_number} elements retrieved")
-            try:
-                newest_date = page.get('data')[0].get('created_at')
-                oldest_date = page.get('data')[-1].get('created_at')
-                print(f"from date {oldest_date} to date {newest_date}")
-            except (IndexError, KeyError):
-                print("created_at data missing")
-            for tweet in page.get('data'):
-                if tweet.get('id') not in done_ids:
-                    jsonl_file.write(json.dumps(tweet) + "\n")
-                    new_tweets_counter += 1
-    print(f"{new_tweets_counter} tweets were added to existing file")
+        for month_tuple in year
+    ]
+    governor = RateLimitGovernor(requests_per_window=requests_per_window)
+    budget = RequestBudget(max_requests=max_requests, max_tweets=max_tweets)
+    reports = map_ordered(
+        partial(
+            _harvest_window,
+            search_args=search_args,
+            stream_factory=stream_factory,
+            governor=governor,
+            budget=budget),
+        windows,
+        num_windows,
+        use_threads=True
+    )
+    for report in reports:
+        print(
+            f"{os.path.basename(report['file_path'])} : {report['new_tweets']} new tweets, "
+            f"{report['pages']} pages in {report['seconds']:.1f}s "
+            f"({report['new_tweets'] / max(report['seconds'], 1e-9):.1f} tweets/s), "
+            f"{'complete' if report['completed'] else 'incomplete'}")
+    print(f"{budget.requests} requests, {budget.tweets} new tweets, "
+          f"{governor.waited_seconds:.0f}s waited for rate limits")
+    return reports
+
 
+def _harvest_window(window, search_args, stream_factory, governor, budget) -> Dict:
+    file_path, query = window
+    print(f"Retrieving tweets for {os.path.basename(file_path)}")
+    return harvest_month(file_path, query, search_args, stream_factory, governor, budget)
 
-def write_new_file(file_path: str, stream_search):
+
+def checkpoint_path(file_path: str) -> str:
+    return f"{file_path}.checkpoint.json"
+
+
+def read_checkpoint(file_path: str) -> Dict:
+    if not os.path.exists(checkpoint_path(file_path)):
+        return {}
+    with open(checkpoint_path(file_path), 'r') as checkpoint_file:
+        return json.loads(checkpoint_file.read())
+
+
+def write_checkpoint(file_path: str, checkpoint: Dict) -> None:
+    """
+    Write the checkpoint of a month file atomically, a crash never leaves a
+    partially written checkpoint
+    """
+    temp_path = f"{checkpoint_path(file_path)}.tmp"
+    with open(temp_path, 'w') as checkpoint_file:
+        checkpoint_file.write(json.dumps(checkpoint))
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temp_path, checkpoint_path(file_path))
+
+
+def resume_request(query, next_token: str):
+    request_parameters = json.loads(query) if isinstance(query, str) else dict(query)
+    request_parameters.update({"next_token": next_token})
+    return json.dumps(request_parameters)
+
+
+def harvest_month(
+        file_path: str,
+        query,
+        search_args,
+        stream_factory=create_stream,
+        governor: RateLimitGovernor = None,
+        budget: RequestBudget = None) -> Dict:
+    """
+    Stream the pages of a month query into its jsonl file, skipping the tweets
+    already in the file (ids held in a set). After each page, a checkpoint next
+    to the file records the pagination token of the next page, the newest and
+    oldest created_at retrieved and whether the month is complete, so that an
+    interrupted harvest resumes from the last written page and a completed
+    month is not queried again.
+    Each page request is paced by the governor and taken from the budget, the
+    harvest stops (incomplete) when the budget is exhausted.
+    Returns the number of pages and new tweets, the duration and completion
+    """
+    start = time.perf_counter()
+    report = {"file_path": file_path, "pages": 0, "new_tweets": 0, "seconds": 0.0, "completed": True}
+    checkpoint = read_checkpoint(file_path)
+    if checkpoint.get("completed"):
+        print(f"{file_path} already complete, skipping")
+        return report
+    deduplicator = IdDeduplicator()
+    if os.path.exists(file_path):
+        drop_partial_last_line(file_path)
+        for tweet in read_jsonl_generator(file_path, fields=['id']):
+            deduplicator.add(tweet.get('id'))
+    if checkpoint.get("next_token"):
+        print(f"resuming from page token {checkpoint.get('next_token')}")
+        query = resume_request(query, checkpoint.get("next_token"))
+    checkpoint = {
+        "next_token": checkpoint.get("next_token"),
+        "newest_created_at": checkpoint.get("newest_created_at"),
+        "oldest_created_at": checkpoint.get("oldest_created_at"),
+        "completed": False
+    }
+    pages = iter(stream_factory(query, search_args).stream())
     page_number = 0
-    with open(file_path, 'w') as jsonl_file:
-        for page in stream_search.stream():
+    new_tweets_counter = 0
+    completed = False
+    with open(file_path, 'a') as jsonl_file:
+        while True:
+            if budget is not None and not budget.take_request():
+                print(f"request budget exhausted, stopping {file_path}")
+                break
+            if governor is not None:
+                governor.acquire()
+            page = next(pages, None)
+            if page is None:
+                completed = True
+                break
             items_number = page.get('meta').get('result_count')
             page_number += 1
             print(f"page n°{page_number} with {items_number} elements retrieved")
+            tweets = page.get('data') or []
             try:
-                newest_date = page.get('data')[0].get('created_at')
-                oldest_date = page.get('data')[-1].get('created_at')
+                newest_date = tweets[0].get('created_at')
+                oldest_date = tweets[-1].get('created_at')
                 print(f"from date {oldest_date} to date {newest_date}")
-            except (IndexError, KeyError):
+                checkpoint.update({
+                    "newest_created_at": max(filter(None, [checkpoint.get("newest_created_at"), newest_date])),
+                    "oldest_created_at": min(filter(None, [checkpoint.get("oldest_created_at"), oldest_date]))
+                })
+            except (IndexError, KeyError, ValueError):
                 print("created_at data missing")
-            for tweet in page.get('data'):
-                jsonl_file.write(json.dumps(tweet) + "\n")
+            page_tweets_counter = 0
+            for tweet in tweets:
+                if deduplicator.add(tweet.get('id')):
+                    jsonl_file.write(json_dumps(tweet) + "\n")
+                    page_tweets_counter += 1
+            jsonl_file.flush()
+            new_tweets_counter += page_tweets_counter
+            if budget is not None:
+                budget.add_tweets(page_tweets_counter)
+            checkpoint["next_token"] = page.get('meta').get('next_token')
+            write_checkpoint(file_path, checkpoint)
+            if not checkpoint["next_token"]:
+                completed = True
+                break
+    if completed:
+        checkpoint.update({"next_token": None, "completed": True})
+        write_checkpoint(file_path, checkpoint)
+    print(f"{new_tweets_counter} new tweets written to {file_path}")
+    report.update({
+        "pages": page_number,
+        "new_tweets": new_tweets_counter,
+        "seconds": time.perf_counter() - start,
+        "completed": completed
+    })
+    return report
 
 
 if __name__ == '__main__':
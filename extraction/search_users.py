@@ -1,7 +1,12 @@
+import heapq
+import logging
 import requests
 import json
 import os
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import count
+from typing import List, Dict
 
 import pandas as pd
 import plotly.express as px
@@ -10,8 +15,17 @@ from tqdm import tqdm
 
 from searchtweets import load_credentials
 
-from utils.file_utils import read_corpus_generator, read_txt_list
+from utils.dedup import IdDeduplicator
+from utils.file_utils import (
+    read_corpus_generator,
+    read_corpus_lines,
+    read_txt_list,
+    json_loads,
+    write_dataframe
+)
+from utils.rate_limit import RateLimitGovernor
 from utils.tweet_utils import is_retweet
+from utils.user_index import UserIndex
 
 
 def read_user_ids_txt(txt_path: str):
@@ -28,11 +42,32 @@ def chunks_generator(lst, n):
 
 def retrieve_user_ids(data_path: str):
     user_ids_list = []
-    for tweet in read_corpus_generator(data_path):
+    for tweet in read_corpus_generator(data_path, fields=['author_id']):
         user_ids_list.append(tweet.get("author_id"))
     return list(set(user_ids_list))
 
 
+USERS_LOOKUP_URL = 'https://api.twitter.com/2/users'
+USERS_PER_REQUEST = 100
+USER_FIELDS = [
+    "id",
+    "created_at",
+    "name",
+    "username",
+    "protected",
+    "verified",
+    "withheld",
+    "profile_image_url",
+    "location",
+    "url",
+    "description",
+    "entities",
+    "pinned_tweet_id",
+    "public_metrics"
+]
+
+
+@lru_cache(maxsize=None)
 def import_credentials():
     credentials = load_credentials("~/.twitter_keys.yaml",
                                    yaml_key="search_tweets_api",
@@ -40,100 +75,172 @@ def import_credentials():
     return credentials
 
 
-def create_url(user_ids: List):
-    user_fields = [
-        "id",
-        "created_at",
-        "name",
-        "username",
-        "protected",
-        "verified",
-        "withheld",
-        "profile_image_url",
-        "location",
-        "url",
-        "description",
-        "entities",
-        "pinned_tweet_id",
-        "public_metrics"
-    ]
+def create_url(user_ids: List, base_url: str = USERS_LOOKUP_URL):
     user_ids = "ids=" + ",".join(user_ids)
-    user_fields = "user.fields=" + ",".join(user_fields)
-    url = f"https://api.twitter.com/2/users?{user_ids}&{user_fields}"
+    user_fields = "user.fields=" + ",".join(USER_FIELDS)
+    url = f"{base_url}?{user_ids}&{user_fields}"
     return url
 
 
-def bearer_oauth(r):
-    bearer_token = import_credentials().get('bearer_token')
-    r.headers["Authorization"] = f"Bearer {bearer_token}"
-    r.headers["User-Agent"] = "v2UserLookupPython"
-    return r
+def create_session(bearer_token: str, pool_size: int = 4) -> requests.Session:
+    """
+    HTTP session reusing its connections, authenticated once
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        "Authorization": f"Bearer {bearer_token}",
+        "User-Agent": "v2UserLookupPython"
+    })
+    return session
 
 
-def connect_to_endpoint(url):
-    response = requests.request("GET", url, auth=bearer_oauth,)
-    print(response.status_code)
-    if response.status_code != 200:
-        raise Exception(
-            "Request returned an error: {} {}".format(
-                response.status_code, response.text
+def lookup_users(
+        session: requests.Session,
+        user_ids: List[str],
+        governor: RateLimitGovernor,
+        base_url: str = USERS_LOOKUP_URL,
+        max_retries: int = 5) -> List[Dict]:
+    """
+    Query the info of up to 100 users, waiting for the rate limit window to
+    reset when it is exhausted or when the API answers 429
+    """
+    for _ in range(max_retries + 1):
+        governor.acquire()
+        response = session.get(create_url(user_ids, base_url))
+        governor.update(response.headers)
+        if response.status_code == 429:
+            logging.warning('rate limit reached, waiting for the window to reset')
+            governor.block_until_reset(response.headers)
+            continue
+        if response.status_code != 200:
+            raise Exception(
+                "Request returned an error: {} {}".format(
+                    response.status_code, response.text
+                )
             )
-        )
-    return response.json()
+        return response.json().get('data', [])
+    raise Exception(f"Request still rate limited after {max_retries} retries")
+
+
+def users_progress_path(output_jsonl_path: str) -> str:
+    return f'{output_jsonl_path}.progress'
 
 
-def query_users_info(data_path: str, output_jsonl_path: str, output_csv_path: str):
-    jsons = []
+def query_users_info(
+        data_path: str,
+        output_jsonl_path: str,
+        output_csv_path: str,
+        max_in_flight: int = 4,
+        base_url: str = USERS_LOOKUP_URL,
+        bearer_token: str = None):
+    """
+    Query the info of all the authors of a corpus, 100 users per request with
+    at most max_in_flight concurrent requests, and append each response to
+    output_jsonl_path as soon as it arrives. The ids of every finished request
+    are recorded in a progress file next to the output, so that an interrupted
+    run resumes with the remaining ids (users already in the output are skipped)
+    """
     all_user_ids = retrieve_user_ids(data_path)
-    for chunk in chunks_generator(all_user_ids, 100):
-        url = create_url(chunk)
-        json_response = connect_to_endpoint(url)
-        jsons.extend(json_response.get('data'))
-    with open(output_jsonl_path, 'a+') as output_file:
-        for json_user_info in jsons:
-            output_file.write(json.dumps(json_user_info, sort_keys=True) + "\n")
+    progress_path = users_progress_path(output_jsonl_path)
+    done_ids = set(read_txt_list(progress_path)) if os.path.exists(progress_path) else set()
+    if os.path.exists(output_jsonl_path):
+        queried_users = UserIndex.from_jsonl(output_jsonl_path)
+        all_user_ids = [user_id for user_id in all_user_ids if user_id not in queried_users]
+    remaining_ids = sorted(user_id for user_id in all_user_ids if user_id not in done_ids)
+    session = create_session(
+        bearer_token or import_credentials().get('bearer_token'), pool_size=max_in_flight)
+    governor = RateLimitGovernor()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor, \
+            open(output_jsonl_path, 'a+') as output_file, \
+            open(progress_path, 'a') as progress_file:
+        futures = {
+            executor.submit(lookup_users, session, chunk, governor, base_url): chunk
+            for chunk in chunks_generator(remaining_ids, USERS_PER_REQUEST)
+        }
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                for json_user_info in future.result():
+                    output_file.write(json.dumps(json_user_info, sort_keys=True) + "\n")
+                output_file.flush()
+                progress_file.write(''.join(f'{user_id}\n' for user_id in futures[future]))
+                progress_file.flush()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    session.close()
+    if governor.waited_seconds:
+        print(f"waited {governor.waited_seconds:.0f} seconds for rate limit windows")
 
 
 def filter_corpus_by_users(data_path: str, user_ids: List[str]):
     tweets = []
-    for tweet in tqdm(read_corpus_generator(data_path)):
+    user_ids = set(user_ids)
+    for line, tweet in tqdm(read_corpus_lines(data_path, fields=['author_id'])):
         if tweet.get('author_id') in user_ids:
-            tweets.append(tweet)
+            tweets.append(json_loads(line))
     return tweets
 
 
+def select_top_tweets_per_user(
+        data_paths: List[str],
+        user_ids: List[str],
+        top_k: int = 5,
+        metric: str = 'retweet_count') -> List[Dict]:
+    """
+    Single streaming pass over several corpora, grouping the original tweets
+    (no retweets, duplicated ids counted once) of the selected users by author,
+    and keeping only the top_k tweets by public metric of each user in a heap
+
+    Args:
+        data_paths: list of jsonl files or directories to read, in order
+        user_ids: ids of the users to select tweets for
+        top_k: number of tweets to keep per user
+        metric: public metric used to rank the tweets of a user
+
+    Returns:
+        list of tweets, grouped by user in the order of user_ids, each group
+        sorted by decreasing metric (ties keep the reading order)
+    """
+    selected_users = set(user_ids)
+    deduplicator = IdDeduplicator()
+    heaps = {}
+    order = count()
+    for data_path in data_paths:
+        for line, tweet in tqdm(read_corpus_lines(
+                data_path, fields=['id', 'author_id', 'referenced_tweets', 'public_metrics'])):
+            author_id = tweet.get('author_id')
+            if author_id not in selected_users or is_retweet(tweet) \
+                    or deduplicator.is_duplicate(tweet.get('id')):
+                continue
+            entry = (tweet.get('public_metrics').get(metric), -next(order), line)
+            user_heap = heaps.setdefault(author_id, [])
+            if len(user_heap) < top_k:
+                heapq.heappush(user_heap, entry)
+            else:
+                heapq.heappushpop(user_heap, entry)
+    top_tweets = []
+    for user_id in dict.fromkeys(user_ids):
+        for _, _, line in sorted(heaps.get(user_id, []), reverse=True):
+            top_tweets.append(json_loads(line))
+    return top_tweets
+
+
 def create_filtered_corpus():
     user_ids = read_txt_list(
         '/Users/juliette/Projects/meTooExtraction/info/search/user_ids.txt'
     )
-    tweets_2021 = filter_corpus_by_users(
-        data_path='/Users/juliette/Desktop/raw_2021',
-        user_ids=user_ids
-    )
-    tweets_2022 = filter_corpus_by_users(
-        data_path='/Users/juliette/Desktop/raw_2022',
-        user_ids=user_ids
+    final_tweets = select_top_tweets_per_user(
+        data_paths=[
+            '/Users/juliette/Desktop/raw_2021',
+            '/Users/juliette/Desktop/raw_2022'
+        ],
+        user_ids=user_ids,
+        top_k=5
     )
-    total_tweets = tweets_2021 + tweets_2022
-    total_tweets = [tweet for tweet in total_tweets if not is_retweet(tweet)]
-    tweet_set = []
-    found_ids = []
-    for tweet in total_tweets:
-        if tweet.get('id') not in found_ids:
-            tweet_set.append(tweet)
-            found_ids.append(tweet.get('id'))
-    user_tweets = {}
-    for user_id in user_ids:
-        for tweet in tweet_set:
-            if tweet.get('author_id') == user_id:
-                if user_id in user_tweets:
-                    user_tweets[user_id] = user_tweets[user_id] + [tweet]
-                else:
-                    user_tweets[user_id] = [tweet]
-    final_tweets = []
-    for key, value in user_tweets.items():
-        value.sort(key=lambda x: x.get('public_metrics').get('retweet_count'), reverse=True)
-        final_tweets.extend(value[:5])
     df = pd.DataFrame.from_records(final_tweets)
     for metric in ['like_count', 'quote_count', 'reply_count', 'retweet_count']:
         df[metric] = df['public_metrics'].apply(
@@ -162,14 +269,21 @@ def filter_and_merge_user_data(
         file_paths_list: list of directories in which to harvest the tweets data
         user_ids_txt_path: path to txt file containing user ids to filter for
         user_data_csv_path: path to csv file of user extended information
-        output_df_path: path to write pandas DataFrame output to
+        output_df_path: path to write pandas DataFrame output to (json, or parquet
+            if the path ends with .parquet)
 
     Returns:
         None, write dataframe to file
     """
     tweets = []
     user_ids_selected = read_user_ids_txt(user_ids_txt_path)
-    users_data = pd.read_csv(user_data_csv_path)
+    user_index = UserIndex.from_records(
+        pd.read_csv(user_data_csv_path, dtype={'user_id': str}).to_dict('records'),
+        key='user_id'
+    )
+    for user_id in user_index.duplicate_ids:
+        logging.warning(f'more than one user data for id : {user_id}, keeping the first one')
+    users_data = pd.DataFrame.from_records(list(user_index.values()))
     for file_path in file_paths_list:
         tweets.extend(
             filter_corpus_by_users(
@@ -183,12 +297,10 @@ def filter_and_merge_user_data(
         right=users_data,
         how='left',
         left_on='author_id',
-        right_on='user_id'
-    )
-    merged.to_json(
-        path_or_buf=output_df_path,
-        orient='table'
+        right_on='user_id',
+        validate='m:1'
     )
+    write_dataframe(merged, output_df_path)
 
 
 if __name__ == "__main__":
@@ -1,44 +1,67 @@
 import os
-from typing import Optional, Dict
+from functools import partial
+from typing import Callable, Optional, Dict
 
 import anthropic
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
-from tqdm import tqdm
 
-from llm_utils import convert_content_to_json
-from utils.df_transform import chunk_dataframe
+from llm_utils import (
+    answer_covers_chunk,
+    dispatch_until_complete,
+    finalize_run,
+    journaled,
+    parse_records,
+    RateLimiter,
+    RunJournal,
+    StreamedRecordParser
+)
+from response_cache import ResponseCache, cache_key, cached_call
+from utils.df_transform import split_dataframe
 from utils.file_utils import read_json_dataframe, read_prompt_file
 
 
-def query_chat(
-        dataframe: pd.DataFrame,
-        prompt: Dict,
-        model_name: Optional[str] = 'claude-3-5-sonnet-20241022',
-        temperature: Optional[float] = 0.2,
-        num_chunks: Optional[int] = 1,
-        stream: Optional[bool] = False) -> pd.DataFrame:
+RATE_LIMITS = {
+    'requests_per_minute': 50,
+    'tokens_per_minute': 40000
+}
+MAX_OUTPUT_TOKENS = 2048
+TOKEN_BUDGETS = {
+    'claude-3-sonnet-20240229': {'max_input_tokens': 16000, 'max_output_tokens': 1600},
+}
 
-    data = dataframe[['id', 'text']]
-    chunks = chunk_dataframe(data, num_chunks)
-    responses = []
 
-    client = anthropic.Anthropic(
-        api_key=os.getenv('ANTHROPIC_API_KEY', '')
-    )
-    for chunk in tqdm(chunks):
-        chunk_json = chunk.to_json(orient='records')
-        messages = [
-            {
-                'role': 'user',
-                'content': [
-                    {
-                        'type': 'text',
-                        'text': prompt.get('content') + f'<t>{chunk_json}</t>'
-                    }
-                ],
-            }
-        ]
+def query_chat_chunk(
+        client: anthropic.Anthropic,
+        chunk: pd.DataFrame,
+        prompt: Dict,
+        model_name: str,
+        temperature: float,
+        stream: bool,
+        cache: Optional[ResponseCache] = None,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    Query a chunk and parse the records of the answer, which may miss rows
+    when it is truncated. on_record is called with each record as soon as it
+    is complete in a streamed answer (after parsing for other answers), from
+    the worker thread of the chunk
+    """
+    streamed_records = None
+    chunk_json = chunk.to_json(orient='records')
+    messages = [
+        {
+            'role': 'user',
+            'content': [
+                {
+                    'type': 'text',
+                    'text': prompt.get('content') + f'<t>{chunk_json}</t>'
+                }
+            ],
+        }
+    ]
+
+    def request_content() -> str:
+        nonlocal streamed_records
         if not stream:
             response = client.messages.create(
                 model=model_name,
@@ -46,36 +69,98 @@ def query_chat(
                 temperature=temperature,
                 stream=stream,
                 system=prompt.get('role'),
-                max_tokens=2048
+                max_tokens=MAX_OUTPUT_TOKENS
             )
-            content = response.content
-        else:
-            with client.messages.stream(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                system=prompt.get('role'),
-                max_tokens=2048
-            ) as stream:
-                collected_messages = []
-                for res_chunk in stream.text_stream:
-                    collected_messages.append(res_chunk)
-                    print(res_chunk, end="", flush=True)
-                content = ''.join([m for m in collected_messages if m is not None])
-
-        mini_df = pd.DataFrame.from_records(
-            convert_content_to_json(content)
+            return ''.join(block.text for block in response.content if block.type == 'text')
+        with client.messages.stream(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            system=prompt.get('role'),
+            max_tokens=MAX_OUTPUT_TOKENS
+        ) as message_stream:
+            record_parser = StreamedRecordParser()
+            streamed_records = []
+            collected_messages = []
+            for res_chunk in message_stream.text_stream:
+                collected_messages.append(res_chunk)
+                for record in record_parser.feed(res_chunk):
+                    streamed_records.append(record)
+                    if on_record is not None:
+                        on_record(record)
+            return ''.join([m for m in collected_messages if m is not None])
+
+    content = cached_call(
+        cache,
+        cache_key('anthropic', model_name, temperature, prompt.get('version'),
+                  [prompt.get('role'), messages]),
+        request_content,
+        validate=lambda answer: answer_covers_chunk(answer, chunk)
+    )
+    if streamed_records is not None:
+        return pd.DataFrame.from_records(streamed_records)
+    records = parse_records(content)
+    if on_record is not None:
+        for record in records:
+            on_record(record)
+    return pd.DataFrame.from_records(records)
+
+
+def query_chat(
+        dataframe: pd.DataFrame,
+        prompt: Dict,
+        model_name: Optional[str] = 'claude-3-5-sonnet-20241022',
+        temperature: Optional[float] = 0.2,
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None,
+        stream: Optional[bool] = False,
+        concurrency: Optional[int] = 1,
+        client: Optional[anthropic.Anthropic] = None,
+        cache: Optional[ResponseCache] = None,
+        journal_path: Optional[str] = None,
+        max_redispatch: int = 1,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    With a journal_path, the records of each chunk are journaled as soon as
+    they are parsed, and a restarted run only queries the ids not done yet.
+    Rows missing from the answers are dispatched again up to max_redispatch times.
+    on_record receives each parsed record as it arrives (see query_chat_chunk)
+    """
+    data = dataframe[['id', 'text']]
+    journal = RunJournal(journal_path) if journal_path is not None else None
+    if journal is not None:
+        data = journal.pending(data)
+    chunks = split_dataframe(data, num_chunks, token_budget) if not data.empty else []
+
+    if client is None:
+        client = anthropic.Anthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY', '')
         )
-        responses.append(mini_df)
-
-    output_dataframe = pd.concat(responses, ignore_index=True)
-    merged = pd.merge(
-        left=dataframe,
-        right=output_dataframe[prompt.get('output_columns')],
-        on='id',
-        how='left',
+    query_chunk = partial(
+        query_chat_chunk,
+        client,
+        prompt=prompt,
+        model_name=model_name,
+        temperature=temperature,
+        stream=stream,
+        cache=cache,
+        on_record=on_record
     )
-    return merged
+    if journal is not None:
+        query_chunk = journaled(query_chunk, journal)
+    responses = dispatch_until_complete(
+        query_chunk,
+        chunks,
+        concurrency=concurrency,
+        rate_limiter=RateLimiter(**RATE_LIMITS) if concurrency > 1 else None,
+        max_redispatch=max_redispatch
+    )
+
+    if journal is not None:
+        output_dataframe = journal.read()
+    else:
+        output_dataframe = pd.concat(responses, ignore_index=True)
+    return finalize_run(dataframe, output_dataframe, prompt.get('output_columns'), validate=None)
 
 
 if __name__ == '__main__':
@@ -93,14 +178,23 @@ if __name__ == '__main__':
         os.getenv('PROMPT_FILE_PATH'),
         task=task
     )
+    response_cache = ResponseCache(
+        os.path.join(os.getenv('OUTPUT_DATASETS_DIR'), 'response_cache')
+    )
     output_df = query_chat(
         dataframe=df,
         prompt=prompt_translate,
-        num_chunks=100,
+        token_budget=TOKEN_BUDGETS[model],
+        journal_path=os.path.join(
+            os.getenv('OUTPUT_DATASETS_DIR'),
+            f'tweets_2017_2019_{task}_{model}_journal.jsonl'
+        ),
         model_name=model,
         temperature=0.2,
-        stream=True
+        stream=True,
+        cache=response_cache
     )
+    response_cache.report()
     output_df.to_json(
         os.path.join(
             os.getenv('OUTPUT_DATASETS_DIR'),
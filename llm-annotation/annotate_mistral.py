@@ -1,4 +1,5 @@
-from typing import Optional, List, Dict
+from functools import partial
+from typing import Callable, Optional, List, Dict
 
 import pandas as pd
 from dotenv import find_dotenv, load_dotenv
@@ -8,29 +9,45 @@ import os
 
 from tqdm import tqdm
 
-from llm_utils import convert_content_to_json
-from utils.df_transform import chunk_dataframe
+from llm_utils import (
+    answer_covers_chunk,
+    dispatch_until_complete,
+    finalize_run,
+    journaled,
+    parse_records,
+    RateLimiter,
+    RunJournal,
+    StreamedRecordParser
+)
+from response_cache import ResponseCache, cache_key, cached_call
+from utils.df_transform import split_dataframe
 from utils.file_utils import read_json_dataframe, read_prompt_file, read_pdf_bibliography
 
 
 def query_embeddings(
         dataframe: pd.DataFrame,
         model_name: Optional[str] = 'mistral-embed',
-        num_chunks: Optional[int] = 1) -> pd.DataFrame:
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None,
+        cache: Optional[ResponseCache] = None) -> pd.DataFrame:
 
     data = dataframe[['id', 'text']]
-    chunks = chunk_dataframe(data, num_chunks)
+    chunks = split_dataframe(data, num_chunks, token_budget)
     outputs = []
 
     client = Mistral(
         api_key=os.getenv('MISTRAL_API_KEY', '')
     )
     for chunk in tqdm(chunks):
-        chunk_response = client.embeddings.create(
-            model=model_name,
-            inputs=chunk['text'].tolist()
+        texts = chunk['text'].tolist()
+        chunk[f'{model_name}_embeddings'] = cached_call(
+            cache,
+            cache_key('mistral', model_name, None, None, texts),
+            lambda: [emb.embedding for emb in client.embeddings.create(
+                model=model_name,
+                inputs=texts
+            ).data]
         )
-        chunk[f'{model_name}_embeddings'] = [emb.embedding for emb in chunk_response.data]
         outputs.append(chunk)
 
     output_dataframe = pd.concat(outputs, ignore_index=True)
@@ -44,34 +61,46 @@ def query_embeddings(
     return merged
 
 
-def query_chat(
-        dataframe: pd.DataFrame,
-        prompt: Dict,
-        model_name: Optional[str] = 'mistral-large-latest',
-        temperature: Optional[float] = 0.2,
-        num_chunks: Optional[int] = 1,
-        stream: Optional[bool] = False) -> pd.DataFrame:
+RATE_LIMITS = {
+    'requests_per_minute': 60,
+    'tokens_per_minute': 500000
+}
+TOKEN_BUDGETS = {
+    'mistral-large-latest': {'max_input_tokens': 16000, 'max_output_tokens': 6000},
+    'mistral-embed': {'max_input_tokens': 15000},
+}
 
-    data = dataframe[['id', 'text']]
-    chunks = chunk_dataframe(data, num_chunks)
-    responses = []
 
-    client = Mistral(
-        api_key=os.getenv('MISTRAL_API_KEY', '')
-    )
+def query_chat_chunk(
+        client: Mistral,
+        chunk: pd.DataFrame,
+        prompt: Dict,
+        model_name: str,
+        temperature: float,
+        stream: bool,
+        cache: Optional[ResponseCache] = None,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    Query a chunk and parse the records of the answer, which may miss rows
+    when it is truncated. on_record is called with each record as soon as it
+    is complete in a streamed answer (after parsing for other answers), from
+    the worker thread of the chunk
+    """
+    streamed_records = None
+    chunk_json = chunk.to_json(orient='records')
+    messages = [
+        {
+            'content': prompt.get('role'),
+            'role': 'system',
+        },
+        {
+            'content': prompt.get('content') + f'<t>{chunk_json}</t>',
+            'role': 'user',
+        },
+    ]
 
-    for chunk in tqdm(chunks):
-        chunk_json = chunk.to_json(orient='records')
-        messages = [
-            {
-                'content': prompt.get('role'),
-                'role': 'system',
-            },
-            {
-                'content': prompt.get('content') + f'<t>{chunk_json}</t>',
-                'role': 'user',
-            },
-        ]
+    def request_content() -> str:
+        nonlocal streamed_records
         if not stream:
             response = client.chat.complete(
                 model=model_name,
@@ -81,35 +110,97 @@ def query_chat(
                     'type': 'json_object',
                 }
             )
-            content = response.choices[0].message.content
-        else:
-            response = client.chat.stream(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                response_format={
-                    'type': 'json_object',
-                }
-            )
-            collected_messages = []
-            for res_chunk in response:
-                chunk_content = res_chunk.data.choices[0].delta.content
-                collected_messages.append(chunk_content)
-                print(chunk_content)
-            content = ''.join([m for m in collected_messages if m is not None])
-        mini_df = pd.DataFrame.from_records(
-            convert_content_to_json(content)
+            return response.choices[0].message.content
+        response = client.chat.stream(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            response_format={
+                'type': 'json_object',
+            }
         )
-        responses.append(mini_df)
+        record_parser = StreamedRecordParser()
+        streamed_records = []
+        collected_messages = []
+        for res_chunk in response:
+            chunk_content = res_chunk.data.choices[0].delta.content
+            collected_messages.append(chunk_content)
+            for record in record_parser.feed(chunk_content or ''):
+                streamed_records.append(record)
+                if on_record is not None:
+                    on_record(record)
+        return ''.join([m for m in collected_messages if m is not None])
+
+    content = cached_call(
+        cache,
+        cache_key('mistral', model_name, temperature, prompt.get('version'), messages),
+        request_content,
+        validate=lambda answer: answer_covers_chunk(answer, chunk)
+    )
+    if streamed_records is not None:
+        return pd.DataFrame.from_records(streamed_records)
+    records = parse_records(content)
+    if on_record is not None:
+        for record in records:
+            on_record(record)
+    return pd.DataFrame.from_records(records)
 
-    output_dataframe = pd.concat(responses, ignore_index=True)
-    merged = pd.merge(
-        left=dataframe,
-        right=output_dataframe[prompt.get('output_columns')],
-        on='id',
-        how='left'
+
+def query_chat(
+        dataframe: pd.DataFrame,
+        prompt: Dict,
+        model_name: Optional[str] = 'mistral-large-latest',
+        temperature: Optional[float] = 0.2,
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None,
+        stream: Optional[bool] = False,
+        concurrency: Optional[int] = 1,
+        client: Optional[Mistral] = None,
+        cache: Optional[ResponseCache] = None,
+        journal_path: Optional[str] = None,
+        max_redispatch: int = 1,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    With a journal_path, the records of each chunk are journaled as soon as
+    they are parsed, and a restarted run only queries the ids not done yet.
+    Rows missing from the answers are dispatched again up to max_redispatch times.
+    on_record receives each parsed record as it arrives (see query_chat_chunk)
+    """
+    data = dataframe[['id', 'text']]
+    journal = RunJournal(journal_path) if journal_path is not None else None
+    if journal is not None:
+        data = journal.pending(data)
+    chunks = split_dataframe(data, num_chunks, token_budget) if not data.empty else []
+
+    if client is None:
+        client = Mistral(
+            api_key=os.getenv('MISTRAL_API_KEY', '')
+        )
+    query_chunk = partial(
+        query_chat_chunk,
+        client,
+        prompt=prompt,
+        model_name=model_name,
+        temperature=temperature,
+        stream=stream,
+        cache=cache,
+        on_record=on_record
+    )
+    if journal is not None:
+        query_chunk = journaled(query_chunk, journal)
+    responses = dispatch_until_complete(
+        query_chunk,
+        chunks,
+        concurrency=concurrency,
+        rate_limiter=RateLimiter(**RATE_LIMITS) if concurrency > 1 else None,
+        max_redispatch=max_redispatch
     )
-    return merged
+
+    if journal is not None:
+        output_dataframe = journal.read()
+    else:
+        output_dataframe = pd.concat(responses, ignore_index=True)
+    return finalize_run(dataframe, output_dataframe, prompt.get('output_columns'), validate=None)
 
 
 def query_documents_summary(
@@ -279,7 +370,11 @@ if __name__ == '__main__':
         output_df = query_chat(
             dataframe=df,
             prompt=prompt_dict,
-            num_chunks=100,
+            token_budget=TOKEN_BUDGETS[model],
+            journal_path=os.path.join(
+                os.getenv('OUTPUT_DATASETS_DIR'),
+                f'tweets_2017_2019_{task}_{model}_journal.jsonl'
+            ),
             model_name=model,
             stream=True
         )
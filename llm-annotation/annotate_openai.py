@@ -1,32 +1,49 @@
 import os
-from typing import Optional, Dict
+from functools import partial
+from typing import Callable, Optional, Dict
 
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 from openai import OpenAI
 from tqdm import tqdm
 
-from llm_utils import convert_content_to_json
-from utils.df_transform import chunk_dataframe
+from llm_utils import (
+    answer_covers_chunk,
+    dispatch_until_complete,
+    finalize_run,
+    journaled,
+    parse_records,
+    RateLimiter,
+    RunJournal,
+    StreamedRecordParser
+)
+from response_cache import ResponseCache, cache_key, cached_call
+from utils.df_transform import split_dataframe
 from utils.file_utils import read_json_dataframe, read_prompt_file
 
 
 def query_embeddings(
         dataframe: pd.DataFrame,
         model_name: Optional[str] = 'text-embedding-3-large',
-        num_chunks: Optional[int] = 1):
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None,
+        cache: Optional[ResponseCache] = None):
 
     data = dataframe[['id', 'text']]
-    chunks = chunk_dataframe(data, num_chunks)
+    chunks = split_dataframe(data, num_chunks, token_budget)
     client = OpenAI(api_key=os.getenv('OPENAI_API_KEY', ''))
     outputs = []
 
     for chunk in tqdm(chunks):
-        chunk_response = client.embeddings.create(
-            model=model_name,
-            input=chunk['text'].tolist()
+        texts = chunk['text'].tolist()
+        chunk[f'{model_name}_embeddings'] = cached_call(
+            cache,
+            cache_key('openai', model_name, None, None, texts),
+            lambda: [emb.embedding for emb in client.embeddings.create(
+                model=model_name,
+                input=texts
+            ).data]
         )
-        chunk[f'{model_name}_embeddings'] = [emb.embedding for emb in chunk_response.data]
         outputs.append(chunk)
 
     output_dataframe = pd.concat(outputs, ignore_index=True)
@@ -40,33 +57,47 @@ def query_embeddings(
     return merged
 
 
-def query_chat(
-        dataframe: pd.DataFrame,
-        prompt: Dict,
-        model_name: Optional[str] = 'gpt-4o',
-        temperature: Optional[float] = 0.2,
-        num_chunks: Optional[int] = 1,
-        stream: Optional[bool] = False) -> pd.DataFrame:
+RATE_LIMITS = {
+    'requests_per_minute': 500,
+    'tokens_per_minute': 30000
+}
+TOKEN_BUDGETS = {
+    'gpt-4o': {'max_input_tokens': 16000, 'max_output_tokens': 12000},
+    'gpt-4o-2024-11-20': {'max_input_tokens': 16000, 'max_output_tokens': 12000},
+    'text-embedding-3-large': {'max_input_tokens': 250000, 'max_rows': 2048},
+}
 
-    data = dataframe[['id', 'text']]
-    chunks = chunk_dataframe(data, num_chunks)
-    responses = []
 
-    client = OpenAI(
-        api_key=os.environ.get('OPENAI_API_KEY')
-    )
-    for chunk in tqdm(chunks):
-        chunk_json = chunk.to_json(orient='records')
-        messages = [
-            {
-                'role': 'developer',
-                'content': prompt.get('role')
-            },
-            {
-                'role': 'user',
-                'content': prompt.get('content') + f'<t>{chunk_json}</t>',
-            }
-        ]
+def query_chat_chunk(
+        client: OpenAI,
+        chunk: pd.DataFrame,
+        prompt: Dict,
+        model_name: str,
+        temperature: float,
+        stream: bool,
+        cache: Optional[ResponseCache] = None,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    Query a chunk and parse the records of the answer, which may miss rows
+    when it is truncated. on_record is called with each record as soon as it
+    is complete in a streamed answer (after parsing for other answers), from
+    the worker thread of the chunk
+    """
+    streamed_records = None
+    chunk_json = chunk.to_json(orient='records')
+    messages = [
+        {
+            'role': 'developer',
+            'content': prompt.get('role')
+        },
+        {
+            'role': 'user',
+            'content': prompt.get('content') + f'<t>{chunk_json}</t>',
+        }
+    ]
+
+    def request_content() -> str:
+        nonlocal streamed_records
         response = client.chat.completions.create(
             model=model_name,
             messages=messages,
@@ -74,28 +105,89 @@ def query_chat(
             stream=stream
         )
         if stream:
+            record_parser = StreamedRecordParser()
+            streamed_records = []
             collected_messages = []
             for res_chunk in response:
                 chunk_content = res_chunk.choices[0].delta.content
                 collected_messages.append(chunk_content)
-                print(chunk_content)
-            content = ''.join([m for m in collected_messages if m is not None])
-        else:
-            content = response.choices[0].message.content
-        mini_df = pd.DataFrame.from_records(
-            convert_content_to_json(content)
-        )
-        responses.append(mini_df)
+                for record in record_parser.feed(chunk_content or ''):
+                    streamed_records.append(record)
+                    if on_record is not None:
+                        on_record(record)
+            return ''.join([m for m in collected_messages if m is not None])
+        return response.choices[0].message.content
+
+    content = cached_call(
+        cache,
+        cache_key('openai', model_name, temperature, prompt.get('version'), messages),
+        request_content,
+        validate=lambda answer: answer_covers_chunk(answer, chunk)
+    )
+    if streamed_records is not None:
+        return pd.DataFrame.from_records(streamed_records)
+    records = parse_records(content)
+    if on_record is not None:
+        for record in records:
+            on_record(record)
+    return pd.DataFrame.from_records(records)
 
-    output_dataframe = pd.concat(responses, ignore_index=True)
-    merged = pd.merge(
-        left=dataframe,
-        right=output_dataframe[prompt.get('output_columns')],
-        on='id',
-        how='left',
-        validate='1:1'
+
+def query_chat(
+        dataframe: pd.DataFrame,
+        prompt: Dict,
+        model_name: Optional[str] = 'gpt-4o',
+        temperature: Optional[float] = 0.2,
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None,
+        stream: Optional[bool] = False,
+        concurrency: Optional[int] = 1,
+        client: Optional[OpenAI] = None,
+        cache: Optional[ResponseCache] = None,
+        journal_path: Optional[str] = None,
+        max_redispatch: int = 1,
+        on_record: Optional[Callable[[Dict], None]] = None) -> pd.DataFrame:
+    """
+    With a journal_path, the records of each chunk are journaled as soon as
+    they are parsed, and a restarted run only queries the ids not done yet.
+    Rows missing from the answers are dispatched again up to max_redispatch times.
+    on_record receives each parsed record as it arrives (see query_chat_chunk)
+    """
+    data = dataframe[['id', 'text']]
+    journal = RunJournal(journal_path) if journal_path is not None else None
+    if journal is not None:
+        data = journal.pending(data)
+    chunks = split_dataframe(data, num_chunks, token_budget) if not data.empty else []
+
+    if client is None:
+        client = OpenAI(
+            api_key=os.environ.get('OPENAI_API_KEY')
+        )
+    query_chunk = partial(
+        query_chat_chunk,
+        client,
+        prompt=prompt,
+        model_name=model_name,
+        temperature=temperature,
+        stream=stream,
+        cache=cache,
+        on_record=on_record
+    )
+    if journal is not None:
+        query_chunk = journaled(query_chunk, journal)
+    responses = dispatch_until_complete(
+        query_chunk,
+        chunks,
+        concurrency=concurrency,
+        rate_limiter=RateLimiter(**RATE_LIMITS) if concurrency > 1 else None,
+        max_redispatch=max_redispatch
     )
-    return merged
+
+    if journal is not None:
+        output_dataframe = journal.read()
+    else:
+        output_dataframe = pd.concat(responses, ignore_index=True)
+    return finalize_run(dataframe, output_dataframe, prompt.get('output_columns'))
 
 
 if __name__ == '__main__':
@@ -113,14 +205,23 @@ if __name__ == '__main__':
         os.getenv('PROMPT_FILE_PATH'),
         task=task
     )
+    response_cache = ResponseCache(
+        os.path.join(os.getenv('OUTPUT_DATASETS_DIR'), 'response_cache')
+    )
     output_df = query_chat(
         dataframe=df,
         prompt=prompt_translate,
-        num_chunks=100,
+        token_budget=TOKEN_BUDGETS[model],
+        journal_path=os.path.join(
+            os.getenv('OUTPUT_DATASETS_DIR'),
+            f'tweets_2017_2019_{task}_{model}_journal.jsonl'
+        ),
         model_name=model,
         temperature=0.3,
-        stream=True
+        stream=True,
+        cache=response_cache
     )
+    response_cache.report()
     output_df.to_json(
         os.path.join(
             os.getenv('OUTPUT_DATASETS_DIR'),
@@ -1,11 +1,292 @@
+import asyncio
 import json
-from typing import Dict
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
+import pandas as pd
+from tqdm import tqdm
 
-def convert_content_to_json(content: str) -> Dict:
-    json_content = content.replace(
-        '```json', ''
-    ).replace(
-        '```', ''
+from utils.df_transform import count_tokens
+from utils.file_utils import drop_partial_last_line, json_dumps, read_jsonl_lines
+
+
+class StreamedRecordParser:
+    """
+    Incremental extraction of the records (json objects that are elements of
+    an array, at any depth) of a streamed LLM answer: feed() takes the next
+    piece of text and returns the records completed by it. Text around the
+    json (code fences, comments) is ignored, and the complete records of a
+    truncated answer are still returned
+    """
+
+    def __init__(self):
+        self._containers = []
+        self._in_string = False
+        self._escaped = False
+        self._record = []
+        self._record_depth = None
+
+    def feed(self, text: str) -> List[Dict]:
+        records = []
+        for char in text:
+            if self._record_depth is not None:
+                self._record.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = bool(self._containers)
+            elif char in '[{':
+                if char == '{' and self._record_depth is None and self._containers[-1:] == ['[']:
+                    self._record_depth = len(self._containers)
+                    self._record = [char]
+                self._containers.append(char)
+            elif char in ']}' and self._containers:
+                self._containers.pop()
+                if self._record_depth == len(self._containers):
+                    try:
+                        record = json.loads(''.join(self._record))
+                    except ValueError:
+                        record = None
+                    if isinstance(record, dict):
+                        records.append(record)
+                    self._record_depth = None
+                    self._record = []
+        return records
+
+
+def parse_records(content: str) -> List[Dict]:
+    return StreamedRecordParser().feed(content)
+
+
+def missing_rows(chunk: pd.DataFrame, output: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows of a chunk whose id is not in the parsed answer
+    """
+    answered_ids = set(output['id'].astype(str)) if 'id' in output.columns else set()
+    return chunk[~chunk['id'].astype(str).isin(answered_ids)]
+
+
+def answer_covers_chunk(content: str, chunk: pd.DataFrame) -> bool:
+    """
+    Whether an answer holds a record for every row of the chunk
+    """
+    return missing_rows(chunk, pd.DataFrame.from_records(parse_records(content))).empty
+
+
+def estimate_chunk_tokens(chunk: pd.DataFrame) -> int:
+    return count_tokens(chunk.to_json(orient='records'))
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute limits of a provider, as two token buckets
+    refilled continuously. Coroutines wait in acquire() until both buckets
+    hold enough for their request
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            clock: Optional[Callable[[], float]] = time.monotonic):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.waited_seconds = 0.0
+        self._clock = clock
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._updated_at = clock()
+        self._lock = None
+        self._lock_loop = None
+
+    def _refill(self) -> None:
+        now = self._clock()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _delay(self, tokens: int) -> float:
+        delay = 0.0
+        if self.requests_per_minute and self._requests < 1:
+            delay = max(delay, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._tokens < tokens:
+            delay = max(delay, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return delay
+
+    async def acquire(self, tokens: Optional[int] = 0) -> None:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            self._refill()
+            delay = self._delay(tokens)
+            while delay > 0:
+                self.waited_seconds += delay
+                await asyncio.sleep(delay)
+                self._refill()
+                delay = self._delay(tokens)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+
+async def _dispatch_chunks(
+        query_chunk: Callable[[pd.DataFrame], pd.DataFrame],
+        chunks: List[pd.DataFrame],
+        concurrency: int,
+        rate_limiter: Optional[RateLimiter]) -> List[pd.DataFrame]:
+    semaphore = asyncio.Semaphore(concurrency)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    progress_bar = tqdm(total=len(chunks))
+
+    async def run(chunk: pd.DataFrame) -> pd.DataFrame:
+        async with semaphore:
+            if rate_limiter is not None:
+                await rate_limiter.acquire(estimate_chunk_tokens(chunk))
+            response = await asyncio.to_thread(query_chunk, chunk)
+            progress_bar.update(1)
+            return response
+
+    try:
+        return await asyncio.gather(*[run(chunk) for chunk in chunks])
+    finally:
+        progress_bar.close()
+
+
+def dispatch_chunks(
+        query_chunk: Callable[[pd.DataFrame], pd.DataFrame],
+        chunks: List[pd.DataFrame],
+        concurrency: Optional[int] = 1,
+        rate_limiter: Optional[RateLimiter] = None) -> List[pd.DataFrame]:
+    """
+    Send the chunks of a dataframe to a provider with up to concurrency
+    requests in flight (blocking client calls run in threads), within the
+    provider rate limits, and return the responses in the order of the chunks
+    """
+    if concurrency <= 1 and rate_limiter is None:
+        return [query_chunk(chunk) for chunk in tqdm(chunks)]
+    return asyncio.run(_dispatch_chunks(query_chunk, chunks, concurrency, rate_limiter))
+
+
+def dispatch_until_complete(
+        query_chunk: Callable[[pd.DataFrame], pd.DataFrame],
+        chunks: List[pd.DataFrame],
+        concurrency: Optional[int] = 1,
+        rate_limiter: Optional[RateLimiter] = None,
+        max_redispatch: int = 1) -> List[pd.DataFrame]:
+    """
+    Dispatch the chunks, then dispatch again (up to max_redispatch times, and
+    within the same rate limits) the rows missing from their answers
+    """
+    outputs = dispatch_chunks(query_chunk, chunks, concurrency, rate_limiter)
+    pending_chunks, pending_outputs = chunks, outputs
+    for _ in range(max_redispatch):
+        pending_chunks = [
+            missing for missing in (
+                missing_rows(chunk, output) for chunk, output in zip(pending_chunks, pending_outputs)
+            ) if not missing.empty
+        ]
+        if not pending_chunks:
+            break
+        logging.warning(
+            f'{sum(len(chunk) for chunk in pending_chunks)} rows missing from the answers, re-dispatching them')
+        pending_outputs = dispatch_chunks(query_chunk, pending_chunks, concurrency, rate_limiter)
+        outputs.extend(pending_outputs)
+    return outputs
+
+
+class RunJournal:
+    """
+    Append-only jsonl journal of an annotation run: the parsed records of each
+    chunk (keyed by tweet id) are written as soon as the chunk completes, so
+    that an interrupted run restarts with the ids that are not done yet
+    """
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.done_ids = set()
+        self._lock = threading.Lock()
+        if os.path.exists(journal_path):
+            drop_partial_last_line(journal_path)
+            for _, record in read_jsonl_lines(journal_path, skip_corrupt_lines=True, fields=['id']):
+                self.done_ids.add(str(record.get('id')))
+
+    def pending(self, dataframe: pd.DataFrame) -> pd.DataFrame:
+        return dataframe[~dataframe['id'].astype(str).isin(self.done_ids)]
+
+    def record(self, chunk_output: pd.DataFrame) -> None:
+        """
+        Journal the records of a chunk, an answer without any parsable record
+        (no id column) leaves its rows pending
+        """
+        if 'id' not in chunk_output.columns:
+            return
+        chunk_output = chunk_output[chunk_output['id'].notna()]
+        if chunk_output.empty:
+            return
+        lines = ''.join(
+            json_dumps(record) + '\n' for record in chunk_output.to_dict(orient='records')
+        )
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as journal_file:
+                journal_file.write(lines)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.done_ids.update(chunk_output['id'].astype(str))
+
+    def read(self) -> pd.DataFrame:
+        if not os.path.exists(self.journal_path):
+            return pd.DataFrame(columns=['id'])
+        records = [record for _, record in read_jsonl_lines(self.journal_path, skip_corrupt_lines=True)]
+        if not records:
+            return pd.DataFrame(columns=['id'])
+        return pd.DataFrame.from_records(records).drop_duplicates(subset='id', keep='last')
+
+
+def journaled(
+        query_chunk: Callable[[pd.DataFrame], pd.DataFrame],
+        journal: RunJournal) -> Callable[[pd.DataFrame], pd.DataFrame]:
+    """
+    Wrap a chunk query so that its result is recorded in the journal
+    """
+    def query_and_record(chunk: pd.DataFrame) -> pd.DataFrame:
+        chunk_output = query_chunk(chunk)
+        journal.record(chunk_output)
+        return chunk_output
+    return query_and_record
+
+
+def finalize_run(
+        dataframe: pd.DataFrame,
+        output_dataframe: pd.DataFrame,
+        output_columns: List[str],
+        validate: Optional[str] = '1:1') -> pd.DataFrame:
+    """
+    Merge the annotations of a run (all responses, or its journal) into the dataset
+    """
+    output_dataframe = output_dataframe.reindex(columns=output_columns)
+    return pd.merge(
+        left=dataframe,
+        right=output_dataframe,
+        on='id',
+        how='left',
+        validate=validate
     )
-    return json.loads(json_content)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from typing import Any, Callable, Optional
+
+
+def payload_hash(payload: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+
+def cache_key(
+        provider: str,
+        model_name: str,
+        temperature: Optional[float],
+        prompt_version: Optional[str],
+        payload: Any) -> str:
+    """
+    Content address of a request: provider, model, temperature, prompt
+    version and the hash of everything sent (messages, texts...)
+    """
+    return payload_hash([provider, model_name, temperature, prompt_version, payload_hash(payload)])
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of LLM / translation responses, one json file per
+    content-addressed request. Reads refresh the modification time of their
+    file, and the least recently used files are evicted when the cache grows
+    over max_size_bytes. Safe to share between the threads of a dispatch
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: Optional[int] = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    def _entry_paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith('.json'):
+                    yield os.path.join(root, file_name)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key: str, validate: Optional[Callable[[Any], bool]] = None) -> Optional[Any]:
+        """
+        Cached value of a key, an entry rejected by validate is deleted
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as entry_file:
+                value = json.loads(entry_file.read())
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            value = None
+        if value is not None and validate is not None and not validate(value):
+            self.delete(key)
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as entry_file:
+            entry_file.write(json.dumps(value, ensure_ascii=False))
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path)
+        with self._lock:
+            self._size += os.path.getsize(path) - previous_size
+            if self.max_size_bytes is not None and self._size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(
+            ((os.path.getmtime(path), os.path.getsize(path), path) for path in self._entry_paths()),
+            key=lambda entry: entry[0]
+        )
+        for _, size, path in entries:
+            if self._size <= self.max_size_bytes:
+                break
+            os.remove(path)
+            self._size -= size
+            self.evictions += 1
+
+    def report(self) -> None:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        print(f"cache {self.cache_dir} : {self.hits} hits, {self.misses} misses "
+              f"({hit_rate:.1%} hit rate), {self.evictions} evictions, "
+              f"{self._size / (1 << 20):.1f} MB on disk")
+
+
+def cached_call(
+        cache: Optional[ResponseCache],
+        key: str,
+        compute: Callable[[], Any],
+        validate: Optional[Callable[[Any], bool]] = None) -> Any:
+    """
+    Serve a response from the cache, or compute it and store it.
+    With validate, only valid responses are stored (and served), so that a
+    truncated or malformed answer is requested again instead of replayed
+    """
+    if cache is None:
+        return compute()
+    value = cache.get(key, validate)
+    if value is None:
+        value = compute()
+        if validate is None or validate(value):
+            cache.put(key, value)
+    return value
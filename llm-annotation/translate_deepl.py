@@ -5,21 +5,27 @@ import deepl
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 
+from response_cache import ResponseCache, cache_key, cached_call
 from utils.file_utils import read_json_dataframe
 
 
 def query_translation(
         dataframe: pd.DataFrame,
         text_column: Optional[str] = 'text',
-        translation_column: Optional[str] = 'text_en') -> pd.DataFrame:
+        translation_column: Optional[str] = 'text_en',
+        cache: Optional[ResponseCache] = None) -> pd.DataFrame:
 
     translator = deepl.Translator(os.getenv('DEEPL_API_KEY'))
 
     dataframe[translation_column] = dataframe[text_column].apply(
-        lambda x: translator.translate_text(
-            text=x,
-            target_lang='EN-GB'
-        ).text
+        lambda x: cached_call(
+            cache,
+            cache_key('deepl', 'EN-GB', None, None, x),
+            lambda: translator.translate_text(
+                text=x,
+                target_lang='EN-GB'
+            ).text
+        )
     )
 
     return dataframe
@@ -34,7 +40,11 @@ if __name__ == '__main__':
         remove_duplicates=True
     )
 
-    output_df = query_translation(df)
+    response_cache = ResponseCache(
+        os.path.join(os.getenv('OUTPUT_DATASETS_DIR'), 'response_cache')
+    )
+    output_df = query_translation(df, cache=response_cache)
+    response_cache.report()
     output_df.to_json(
         os.path.join(
             os.getenv('OUTPUT_DATASETS_DIR'),
@@ -14,7 +14,7 @@ from sklearn.cluster import (
 from sklearn.manifold import TSNE
 from umap import UMAP
 
-from utils.file_utils import read_json_dataframe
+from utils.file_utils import read_json_dataframe, read_embeddings_matrix
 
 
 def plot_dendrogram(model, **kwargs):
@@ -38,15 +38,37 @@ def plot_dendrogram(model, **kwargs):
     dendrogram(linkage_matrix, **kwargs)
 
 
+def get_embeddings_matrix(
+        dataframe: pd.DataFrame,
+        embeddings_column: str,
+        embeddings_path: Optional[str] = None) -> np.ndarray:
+    """
+    Float32 embeddings matrix aligned to the dataframe rows. With embeddings_path,
+    rows are taken from the memory-mapped store: a view without any copy when the
+    dataframe rows follow the store order, otherwise only the needed rows are copied
+    """
+    if not embeddings_path:
+        return np.asarray(dataframe[embeddings_column].to_list(), dtype=np.float32)
+    ids, matrix = read_embeddings_matrix(embeddings_path)
+    positions = pd.Index(ids).get_indexer(dataframe['id'].astype(str))
+    if (positions < 0).any():
+        raise KeyError(
+            f'{(positions < 0).sum()} tweet ids are missing from the embeddings store {embeddings_path}')
+    if len(positions) and (np.diff(positions) == 1).all():
+        return matrix[positions[0]:positions[-1] + 1]
+    return matrix[positions]
+
+
 def tsne_dimensionality_reduction(
         dataframe: pd.DataFrame,
         embeddings_column: str,
-        num_dim: Optional[int] = 2) -> pd.DataFrame:
+        num_dim: Optional[int] = 2,
+        embeddings_path: Optional[str] = None) -> pd.DataFrame:
     reducer = TSNE(
         n_components=num_dim
     )
-    embeddings = dataframe[embeddings_column].to_list()
-    reduced = reducer.fit_transform(np.array(embeddings))
+    embeddings = get_embeddings_matrix(dataframe, embeddings_column, embeddings_path)
+    reduced = reducer.fit_transform(embeddings)
     dataframe[f'tsne_{embeddings_column}_x'] = [dim[0] for dim in reduced]
     dataframe[f'tsne_{embeddings_column}_y'] = [dim[1] for dim in reduced]
     return dataframe
@@ -55,13 +77,14 @@ def tsne_dimensionality_reduction(
 def umap_dimensionality_reduction(
         dataframe: pd.DataFrame,
         embeddings_column: str,
-        num_dim: Optional[int] = 2) -> pd.DataFrame:
+        num_dim: Optional[int] = 2,
+        embeddings_path: Optional[str] = None) -> pd.DataFrame:
     reducer = UMAP(
         n_components=num_dim,
         unique=True
     )
-    embeddings = dataframe[embeddings_column].to_list()
-    reduced = reducer.fit_transform(np.array(embeddings))
+    embeddings = get_embeddings_matrix(dataframe, embeddings_column, embeddings_path)
+    reduced = reducer.fit_transform(embeddings)
     dataframe[f'umap_{embeddings_column}_x'] = [dim[0] for dim in reduced]
     dataframe[f'umap_{embeddings_column}_y'] = [dim[1] for dim in reduced]
     return dataframe
@@ -71,7 +94,8 @@ def agglomerative_clustering(
         dataframe: pd.DataFrame,
         embeddings_column: str,
         n_clusters: Optional[int] = 10,
-        distance_threshold: Optional[int] = None) -> Tuple[pd.DataFrame, AgglomerativeClustering]:
+        distance_threshold: Optional[int] = None,
+        embeddings_path: Optional[str] = None) -> Tuple[pd.DataFrame, AgglomerativeClustering]:
     model = AgglomerativeClustering(
         n_clusters=n_clusters,
         metric='euclidean',
@@ -82,8 +106,8 @@ def agglomerative_clustering(
         distance_threshold=distance_threshold,
         compute_distances=False
     )
-    embeddings = dataframe[embeddings_column].to_list()
-    clustering_labels = model.fit_predict(np.array(embeddings))
+    embeddings = get_embeddings_matrix(dataframe, embeddings_column, embeddings_path)
+    clustering_labels = model.fit_predict(embeddings)
     clustering_labels = [str(label) for label in clustering_labels]
     if not n_clusters:
         column_name = f'clustering_agglo_dist{distance_threshold}'
@@ -96,12 +120,13 @@ def agglomerative_clustering(
 def kmeans_clustering(
         dataframe: pd.DataFrame,
         embeddings_column: str,
-        n_clusters: Optional[int] = 10) -> Tuple[pd.DataFrame, KMeans]:
+        n_clusters: Optional[int] = 10,
+        embeddings_path: Optional[str] = None) -> Tuple[pd.DataFrame, KMeans]:
     model = KMeans(
         n_clusters=n_clusters
     )
-    embeddings = dataframe[embeddings_column].to_list()
-    clustering_labels = model.fit_predict(np.array(embeddings))
+    embeddings = get_embeddings_matrix(dataframe, embeddings_column, embeddings_path)
+    clustering_labels = model.fit_predict(embeddings)
     clustering_labels = [str(label) for label in clustering_labels]
     dataframe[f'clustering_kmeans_{n_clusters}'] = clustering_labels
     return dataframe, model
@@ -113,7 +138,8 @@ if __name__ == '__main__':
 
     df = read_json_dataframe(
         file_path=os.environ.get('LATEST_DATASET_PATH'),
-        remove_duplicates=False
+        remove_duplicates=False,
+        columns=['id', 'mistral-embed_embeddings']
     )
     df, clustering_model = agglomerative_clustering(
         dataframe=df,
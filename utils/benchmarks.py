@@ -0,0 +1,143 @@
+import os
+import time
+from typing import Optional, List
+
+import pandas as pd
+from dotenv import load_dotenv, find_dotenv
+
+from utils.df_transform import (
+    basic_pipeline,
+    add_month_column,
+    add_day_column,
+    extract_hashtags_from_row,
+    is_label_in_referenced,
+    determine_reference_label,
+    add_identities_booleans
+)
+from utils.file_utils import JSON_DECODERS, JSON_ENCODERS, JSON_PROJECTORS, read_json_dataframe
+
+
+def read_raw_lines(jsonl_path: str, max_lines: Optional[int] = None) -> List[str]:
+    """
+    Read raw lines of a jsonl file, so that disk reads are not part of the timings
+    """
+    lines = []
+    with open(jsonl_path, 'r', encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            if max_lines and len(lines) >= max_lines:
+                break
+            lines.append(line)
+    return lines
+
+
+def benchmark_json_backends(
+        jsonl_path: str,
+        max_lines: Optional[int] = None,
+        fields: Optional[List[str]] = ('id', 'author_id', 'lang', 'text')) -> pd.DataFrame:
+    """
+    Time every installed json decoder, field projection and encoder on the
+    tweets of a month file, and check the encoded lines against the stdlib output
+    """
+    lines = read_raw_lines(jsonl_path, max_lines)
+    tweets = [JSON_DECODERS['json'](line) for line in lines]
+    reference_lines = [JSON_ENCODERS['json'](tweet) for tweet in tweets]
+    results = []
+    for backend, loads in JSON_DECODERS.items():
+        start = time.perf_counter()
+        for line in lines:
+            loads(line)
+        decode_time = time.perf_counter() - start
+        project = JSON_PROJECTORS[backend]
+        projected_fields = frozenset(fields)
+        start = time.perf_counter()
+        for line in lines:
+            project(line, projected_fields)
+        project_time = time.perf_counter() - start
+        result = {
+            'backend': backend,
+            'decode_tweets_per_sec': len(lines) / decode_time,
+            'project_tweets_per_sec': len(lines) / project_time,
+            'encode_tweets_per_sec': None,
+            'byte_identical': None,
+            'key_order_identical': None
+        }
+        dumps = JSON_ENCODERS.get(backend)
+        if dumps:
+            start = time.perf_counter()
+            encoded_lines = [dumps(tweet) for tweet in tweets]
+            encode_time = time.perf_counter() - start
+            result.update({
+                'encode_tweets_per_sec': len(tweets) / encode_time,
+                'byte_identical': encoded_lines == reference_lines,
+                'key_order_identical': all(
+                    list(loads(encoded)) == list(tweet)
+                    for encoded, tweet in zip(encoded_lines, tweets))
+            })
+        results.append(result)
+    return pd.DataFrame.from_records(results)
+
+
+def rowwise_basic_pipeline(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Previous implementation of basic_pipeline, built on the row-level
+    functions of df_transform with row-wise apply, kept as the reference
+    """
+    dataframe = add_day_column(add_month_column(dataframe))
+    for column_name, label in {'reply': 'replied_to', 'quote': 'quoted', 'retweet': 'retweeted'}.items():
+        dataframe[column_name] = dataframe.apply(
+            lambda x: is_label_in_referenced(referenced_list=x['referenced_tweets'], label=label),
+            axis=1
+        )
+    dataframe['reference_type'] = dataframe.apply(determine_reference_label, axis=1)
+    dataframe['hashtags'] = dataframe['entities'].apply(extract_hashtags_from_row)
+    for metric in ['retweet_count', 'quote_count', 'reply_count', 'like_count']:
+        dataframe[metric] = dataframe['public_metrics'].apply(lambda x: x.get(metric))
+    identity_columns = [
+        'media', 'journalist', 'victim', 'youtuber', 'academic', 'writer_editor', 'nationalist',
+        'personality', 'politicized', 'activist', 'political', 'feminist_activist', 'jurist',
+        'translator_interpret', 'group_organization', 'meninist_activist'
+    ]
+    dataframe['identities'] = dataframe.apply(
+        lambda row: add_identities_booleans(row, identity_columns), axis=1)
+    return dataframe
+
+
+def benchmark_basic_pipeline(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Time the vectorized basic_pipeline against the row-wise one on copies of
+    the same dataframe, and check that both produce the same columns
+    """
+    results = []
+    outputs = {}
+    for name, pipeline in [('rowwise', rowwise_basic_pipeline), ('vectorized', basic_pipeline)]:
+        copy = dataframe.copy()
+        start = time.perf_counter()
+        outputs[name] = pipeline(copy)
+        elapsed = time.perf_counter() - start
+        results.append({
+            'pipeline': name,
+            'seconds': elapsed,
+            'rows_per_sec': len(dataframe) / elapsed
+        })
+    results = pd.DataFrame.from_records(results)
+    results['identical'] = outputs['rowwise'].equals(outputs['vectorized'])
+    return results
+
+
+if __name__ == '__main__':
+
+    load_dotenv(find_dotenv())
+
+    print(
+        benchmark_json_backends(
+            jsonl_path=os.environ.get('BENCHMARK_JSONL_PATH')
+        ).to_string(index=False)
+    )
+    print(
+        benchmark_basic_pipeline(
+            read_json_dataframe(
+                file_path=os.environ.get('LATEST_DATASET_PATH'),
+                remove_duplicates=True
+            )
+        ).to_string(index=False)
+    )
@@ -0,0 +1,78 @@
+import sqlite3
+from typing import Optional, Iterable, List, Dict
+
+
+class IdDeduplicator:
+    """
+    Keep track of the tweet ids seen during a run, across all of its files,
+    and count the duplicates found in each file. Ids are held in a set, or in
+    an on-disk sqlite index (index_path) for runs too large for memory, which
+    is emptied at the start of the run unless resume is set.
+    A bloom filter is deliberately not offered: its false positives would
+    silently drop unique tweets from the corpus
+    """
+
+    def __init__(self, index_path: Optional[str] = None, resume: Optional[bool] = False):
+        self.index_path = index_path
+        self.duplicates_per_file: Dict[str, int] = {}
+        self._seen_ids = None
+        self._connection = None
+        if index_path:
+            self._connection = sqlite3.connect(index_path)
+            self._connection.execute('PRAGMA journal_mode=OFF')
+            self._connection.execute('PRAGMA synchronous=OFF')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS seen_ids (id TEXT PRIMARY KEY)')
+            if not resume:
+                self._connection.execute('DELETE FROM seen_ids')
+        else:
+            self._seen_ids = set()
+
+    def add(self, tweet_id) -> bool:
+        """
+        Record an id, return False if it was already seen
+        """
+        if self._seen_ids is not None:
+            if tweet_id in self._seen_ids:
+                return False
+            self._seen_ids.add(tweet_id)
+            return True
+        cursor = self._connection.execute(
+            'INSERT OR IGNORE INTO seen_ids VALUES (?)', (str(tweet_id),))
+        return cursor.rowcount == 1
+
+    def is_duplicate(self, tweet_id, file_name: Optional[str] = None) -> bool:
+        """
+        Return True if the id was already seen in the run, otherwise record it
+        """
+        is_new = self.add(tweet_id)
+        if not is_new and file_name:
+            self.duplicates_per_file[file_name] = self.duplicates_per_file.get(file_name, 0) + 1
+        return not is_new
+
+    def keep_mask(self, tweet_ids: Iterable, file_name: Optional[str] = None) -> List[bool]:
+        """
+        Boolean mask of the ids seen for the first time, usable to filter a dataframe
+        """
+        return [not self.is_duplicate(tweet_id, file_name) for tweet_id in tweet_ids]
+
+    def __contains__(self, tweet_id) -> bool:
+        if self._seen_ids is not None:
+            return tweet_id in self._seen_ids
+        return self._connection.execute(
+            'SELECT 1 FROM seen_ids WHERE id = ?', (str(tweet_id),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        if self._seen_ids is not None:
+            return len(self._seen_ids)
+        return self._connection.execute('SELECT COUNT(*) FROM seen_ids').fetchone()[0]
+
+    def report(self) -> None:
+        for file_name, count in sorted(self.duplicates_per_file.items()):
+            print(f"{count} duplicates removed from {file_name}")
+        print(f"Removed {sum(self.duplicates_per_file.values())} duplicates in total")
+
+    def close(self) -> None:
+        if self._connection:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
@@ -1,6 +1,7 @@
 import os
 import re
-from functools import reduce
+from functools import lru_cache, reduce
+from itertools import compress
 from typing import List, Optional, Dict
 
 import numpy as np
@@ -9,6 +10,15 @@ from dotenv import load_dotenv, find_dotenv
 
 from utils.file_utils import read_json_dataframe
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKENIZER_ENCODING = 'cl100k_base'
+CJK_PATTERN = re.compile('[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+ESCAPED_UNICODE_PATTERN = re.compile(r'\\u[0-9a-fA-F]{4}')
+
 
 def df_pipeline(dataframe, functions):
     """
@@ -63,13 +73,34 @@ def extract_hashtags_from_row(row: pd.Series) -> List[str]:
     return []
 
 
+def explode_dict_lists(series: pd.Series) -> pd.Series:
+    """
+    Explode a column of lists of dicts (such as referenced_tweets or the
+    hashtags of entities) into one dict per row, indexed by the row position
+    of the list it comes from. Cells that are not lists are ignored
+    """
+    cells = series.to_numpy()
+    is_list = np.fromiter((isinstance(cell, list) for cell in cells), dtype=bool, count=len(cells))
+    exploded = pd.Series(
+        cells[is_list],
+        index=np.flatnonzero(is_list),
+        dtype=object
+    ).explode()
+    return exploded[exploded.map(lambda item: isinstance(item, dict))]
+
+
 def add_hashtags_column(dataframe: pd.DataFrame) -> pd.DataFrame:
     """
     Create a column for the hashtags identified in a tweet
     """
-    dataframe['hashtags'] = dataframe['entities'].apply(
-        lambda row: extract_hashtags_from_row(row)
-    )
+    entities = dataframe['entities'].to_numpy()
+    is_dict = np.fromiter((isinstance(cell, dict) for cell in entities), dtype=bool, count=len(entities))
+    hashtag_lists = pd.Series(entities[is_dict], index=np.flatnonzero(is_dict), dtype=object)
+    tags = explode_dict_lists(hashtag_lists.str.get('hashtags')).str.get('tag')
+    hashtags = [[] for _ in range(len(dataframe))]
+    for position, row_tags in tags.groupby(level=0).agg(list).items():
+        hashtags[hashtag_lists.index[position]] = row_tags
+    dataframe['hashtags'] = hashtags
     return dataframe
 
 
@@ -115,14 +146,11 @@ def add_quote_reply_retweet_columns(
         'quote': 'quoted',
         'retweet': 'retweeted'
     }
+    reference_types = explode_dict_lists(dataframe['referenced_tweets']).str.get('type')
     for column_name, label in column_mapping.items():
-        dataframe[column_name] = dataframe.apply(
-            lambda x: is_label_in_referenced(
-                referenced_list=x['referenced_tweets'],
-                label=label
-            ),
-            axis=1
-        )
+        is_label = np.zeros(len(dataframe), dtype=bool)
+        is_label[reference_types.index[reference_types == label]] = True
+        dataframe[column_name] = is_label
     return dataframe
 
 
@@ -145,9 +173,15 @@ def add_reference_type_column(
     """
     Add column based on the four reference types {original, quote, reply, retweet}
     """
-    dataframe['reference_type'] = dataframe.apply(
-        determine_reference_label, axis=1
-    )
+    dataframe['reference_type'] = np.select(
+        condlist=[
+            dataframe['retweet'].astype(bool),
+            dataframe['quote'].astype(bool),
+            dataframe['reply'].astype(bool)
+        ],
+        choicelist=['retweet', 'quote', 'reply'],
+        default='original'
+    ).astype(object)
     return dataframe
 
 
@@ -157,10 +191,12 @@ def add_public_metrics_column(
     Add column based on the public metrics {retweet_count, quote_count, reply_count, like_count}
     """
     metrics = ['retweet_count', 'quote_count', 'reply_count', 'like_count']
+    metrics_dataframe = pd.DataFrame.from_records(
+        dataframe['public_metrics'].to_list(),
+        columns=metrics
+    )
     for metric in metrics:
-        dataframe[metric] = dataframe['public_metrics'].apply(
-            lambda x: x.get(metric)
-        )
+        dataframe[metric] = metrics_dataframe[metric].to_numpy()
     return dataframe
 
 
@@ -183,10 +219,10 @@ def add_identity_column(
         'personality', 'politicized', 'activist', 'political', 'feminist_activist', 'jurist',
         'translator_interpret', 'group_organization', 'meninist_activist'
     ]
-    dataframe['identities'] = dataframe.apply(
-        lambda row: add_identities_booleans(row, identity_columns),
-        axis=1
-    )
+    identity_mask = dataframe[identity_columns].astype(bool).to_numpy()
+    dataframe['identities'] = [
+        list(compress(identity_columns, row_mask)) for row_mask in identity_mask
+    ]
     return dataframe
 
 
@@ -273,6 +309,76 @@ def chunk_dataframe(
     return chunks
 
 
+@lru_cache(maxsize=1)
+def _tokenizer():
+    return tiktoken.get_encoding(TOKENIZER_ENCODING) if tiktoken is not None else None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Number of tokens of a text with the local tiktoken tokenizer when it is
+    installed, otherwise a heuristic: a token per CJK character, three per
+    escaped unicode character (\\uXXXX, as in pandas json) and a token per
+    four other characters
+    """
+    tokenizer = _tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    num_cjk = len(CJK_PATTERN.findall(text))
+    num_escaped = len(ESCAPED_UNICODE_PATTERN.findall(text))
+    num_other = len(text) - num_cjk - 6 * num_escaped
+    return num_cjk + 3 * num_escaped + num_other // 4 + 1
+
+
+def batch_dataframe_by_tokens(
+        dataframe: pd.DataFrame,
+        max_input_tokens: int,
+        max_output_tokens: Optional[int] = None,
+        output_ratio: Optional[float] = 1.0,
+        max_rows: Optional[int] = None) -> List[pd.DataFrame]:
+    """
+    Split dataframe into consecutive batches packed up to a token budget
+    (mainly for LLM querying): the tokens of the json records of a batch stay
+    under max_input_tokens, and their expected answer (output_ratio times the
+    input tokens) under max_output_tokens. A row over budget on its own makes
+    a batch of one row
+    """
+    if dataframe.empty:
+        return [dataframe]
+    records = dataframe.to_json(orient='records', lines=True).splitlines()
+    batches = []
+    start = 0
+    input_tokens = 0
+    for position, record in enumerate(records):
+        row_tokens = count_tokens(record) + 1
+        next_input_tokens = input_tokens + row_tokens
+        is_full = (
+            next_input_tokens > max_input_tokens
+            or (max_output_tokens is not None and next_input_tokens * output_ratio > max_output_tokens)
+            or (max_rows is not None and position - start >= max_rows)
+        )
+        if is_full and position > start:
+            batches.append(dataframe[start:position])
+            start = position
+            next_input_tokens = row_tokens
+        input_tokens = next_input_tokens
+    batches.append(dataframe[start:])
+    return batches
+
+
+def split_dataframe(
+        dataframe: pd.DataFrame,
+        num_chunks: Optional[int] = 1,
+        token_budget: Optional[Dict] = None) -> List[pd.DataFrame]:
+    """
+    Batch dataframe by tokens when a token budget is given (keyword arguments
+    of batch_dataframe_by_tokens), else split it into num_chunks chunks
+    """
+    if token_budget is not None:
+        return batch_dataframe_by_tokens(dataframe, **token_budget)
+    return chunk_dataframe(dataframe, num_chunks)
+
+
 def replace_punctuation_with_line_break(text: str) -> str:
     return text.replace(
         '、', '、<br>'
@@ -1,44 +1,289 @@
 import csv
-from typing import List, Dict, Optional
+import logging
+from typing import List, Dict, Optional, Iterator, Tuple, Iterable
 
 import chardet
 import json
+import math
 import os
+import threading
 
+import numpy as np
 import pdfplumber
 import pandas as pd
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+JSONL_BUFFER_SIZE = 1 << 20
+PARQUET_JSON_COLUMNS_KEY = b'metoo_json_columns'
+
+
+def _orjson_dumps(entry) -> str:
+    return orjson.dumps(entry).decode('utf-8')
+
+
+def _replace_non_finite(entry):
+    if isinstance(entry, float):
+        return entry if math.isfinite(entry) else None
+    if isinstance(entry, dict):
+        return {key: _replace_non_finite(value) for key, value in entry.items()}
+    if isinstance(entry, (list, tuple)):
+        return [_replace_non_finite(value) for value in entry]
+    return entry
+
+
+def _json_dumps(entry) -> str:
+    """
+    stdlib encoding writing NaN and infinities as null, like orjson, since
+    neither orjson nor simdjson decode the NaN tokens of json.dumps
+    """
+    try:
+        return json.dumps(entry, allow_nan=False)
+    except ValueError:
+        return json.dumps(_replace_non_finite(entry), allow_nan=False)
+
+
+# decoders and encoders available in this environment, fastest first,
+# stdlib json is always last so that it acts as the fallback
+JSON_DECODERS = {
+    name: loads for name, loads in [
+        ('orjson', orjson.loads if orjson else None),
+        ('simdjson', simdjson.loads if simdjson else None),
+        ('json', json.loads)
+    ] if loads
+}
+# only the stdlib encoder writes lines byte-identical to the existing corpus files,
+# orjson keeps the key order but uses compact separators and raw utf-8
+JSON_ENCODERS = {
+    name: dumps for name, dumps in [
+        ('orjson', _orjson_dumps if orjson else None),
+        ('json', _json_dumps)
+    ] if dumps
+}
+_json_codec = {}
+# a simdjson parser cannot be shared while a document it parsed is alive,
+# each thread reading the corpus gets its own
+_simdjson_parsers = threading.local()
+
+
+def _simdjson_project(text: str, fields: frozenset) -> Dict:
+    """
+    simdjson parses lazily, only the requested values are turned into python objects
+    """
+    parser = getattr(_simdjson_parsers, 'parser', None)
+    if parser is None:
+        parser = _simdjson_parsers.parser = simdjson.Parser()
+    document = parser.parse(text.encode('utf-8'))
+    projected = {}
+    for field in fields:
+        if field in document:
+            value = document[field]
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            projected[field] = value
+    return projected
+
+
+def _make_decode_project(loads):
+    """
+    Without lazy parsing the cheapest projection is a full decode with a fast
+    decoder, a python-level scanner skipping subtrees is slower than either
+    """
+    def decode_project(text: str, fields: frozenset) -> Dict:
+        entry = loads(text)
+        return {field: entry[field] for field in fields if field in entry}
+    return decode_project
+
+
+# projections available in this environment, fastest first
+JSON_PROJECTORS = {
+    name: project for name, project in [
+        ('simdjson', _simdjson_project if simdjson else None),
+        ('orjson', _make_decode_project(orjson.loads) if orjson else None),
+        ('json', _make_decode_project(json.loads))
+    ] if project
+}
+
+
+def set_json_backend(backend: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Select the codec used for corpus reads and writes. By default the fastest
+    installed decoder (and field projection) is used together with the
+    byte-identical stdlib encoder, a backend name forces all of them when available
+    """
+    if backend and backend not in JSON_DECODERS:
+        raise ValueError(
+            f'json backend {backend} is not installed, choose from {list(JSON_DECODERS)}')
+    decoder_name = backend or next(iter(JSON_DECODERS))
+    encoder_name = backend if backend in JSON_ENCODERS else 'json'
+    projector_name = backend or next(iter(JSON_PROJECTORS))
+    _json_codec.update({
+        'loads': JSON_DECODERS[decoder_name],
+        'dumps': JSON_ENCODERS[encoder_name],
+        'project': JSON_PROJECTORS[projector_name]
+    })
+    return decoder_name, encoder_name
+
+
+def json_loads(text: str):
+    return _json_codec['loads'](text)
+
+
+def json_dumps(entry) -> str:
+    return _json_codec['dumps'](entry)
+
+
+def json_project(text: str, fields: frozenset) -> Dict:
+    """
+    Decode only the given top-level keys of a json object
+    """
+    return _json_codec['project'](text, fields)
+
+
+set_json_backend(os.environ.get('CORPUS_JSON_BACKEND'))
+
 
 def read_json_file(json_file_path: str):
     with open(json_file_path, 'r') as json_file:
         return json.loads(json_file.read())
 
 
-def read_corpus_generator(data_path: str):
+def jsonl_file_paths(data_path: str) -> List[str]:
+    """
+    The jsonl files of data_path, a file or a directory
+    """
     if os.path.isfile(data_path):
-        yield from read_jsonl_generator(data_path)
+        return [data_path]
+    return [
+        os.path.join(data_path, file_name)
+        for file_name in sorted(os.listdir(data_path)) if file_name.endswith('.jsonl')
+    ]
+
+
+def read_corpus_generator(
+        data_path: str,
+        progress: Optional[bool] = False,
+        fields: Optional[Iterable[str]] = None):
+    for _, entry in read_corpus_lines(data_path, progress=progress, fields=fields):
+        yield entry
+
+
+def read_corpus_lines(
+        data_path: str,
+        progress: Optional[bool] = False,
+        fields: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, Dict]]:
+    if os.path.isfile(data_path):
+        yield from read_jsonl_lines(data_path, progress=progress, fields=fields)
     else:
         for file_name in os.listdir(data_path):
             if file_name.endswith('.jsonl'):
-                yield from read_jsonl_generator(os.path.join(data_path, file_name))
-
-
-def read_jsonl_generator(file_path: str):
-    with open(file_path, 'r') as data_file:
-        for entry in data_file.readlines():
-            yield json.loads(entry)
+                yield from read_jsonl_lines(
+                    os.path.join(data_path, file_name), progress=progress, fields=fields)
+
+
+def drop_partial_last_line(file_path: str) -> None:
+    """
+    Cut the unterminated line left at the end of a file by an interrupted
+    write, so that new lines can be appended to it
+    """
+    with open(file_path, 'rb+') as jsonl_file:
+        jsonl_file.seek(0, os.SEEK_END)
+        size = jsonl_file.tell()
+        position = size
+        while position > 0:
+            step = min(1 << 16, position)
+            jsonl_file.seek(position - step)
+            block = jsonl_file.read(step)
+            line_break = block.rfind(b"\n")
+            if line_break != -1:
+                position = position - step + line_break + 1
+                break
+            position -= step
+        if position != size:
+            jsonl_file.truncate(position)
+
+
+def read_jsonl_lines(
+        file_path: str,
+        buffer_size: Optional[int] = JSONL_BUFFER_SIZE,
+        progress: Optional[bool] = False,
+        skip_corrupt_lines: Optional[bool] = False,
+        fields: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Stream a jsonl file through a bounded read buffer and yield each raw line
+    with its decoded content, reporting progress in bytes read.
+    With fields, only those top-level keys are decoded, the raw line can still
+    be fully decoded with json_loads when needed.
+    A line that cannot be decoded is corrupt (raised, or logged and skipped),
+    unless it is the last line and has no line break, in which case the file
+    was truncated while being written and the partial line is dropped
+    """
+    fields = frozenset(fields) if fields else None
+    with open(file_path, 'rb', buffering=buffer_size) as data_file, tqdm(
+            total=os.path.getsize(file_path),
+            unit='B',
+            unit_scale=True,
+            desc=os.path.basename(file_path),
+            disable=not progress) as progress_bar:
+        for line_number, raw_line in enumerate(data_file, start=1):
+            progress_bar.update(len(raw_line))
+            try:
+                line = raw_line.decode('utf-8')
+                if not line.strip():
+                    continue
+                entry = json_project(line, fields) if fields else json_loads(line)
+            except ValueError as error:
+                if not raw_line.endswith(b'\n'):
+                    logging.warning(
+                        f'truncated last line {line_number} in {file_path}, dropping it')
+                    return
+                if not skip_corrupt_lines:
+                    raise ValueError(
+                        f'corrupt line {line_number} in {file_path}') from error
+                logging.error(f'skipping corrupt line {line_number} in {file_path} : {error}')
+                continue
+            yield line, entry
+
+
+def read_jsonl_generator(
+        file_path: str,
+        progress: Optional[bool] = False,
+        fields: Optional[Iterable[str]] = None):
+    for _, entry in read_jsonl_lines(file_path, progress=progress, fields=fields):
+        yield entry
 
 
 def read_jsonl_list(file_path: str) -> List[Dict]:
-    with open(file_path, 'r') as data_file:
-        return [json.loads(line) for line in data_file.readlines()]
+    return list(read_jsonl_generator(file_path))
 
 
 def read_json_dataframe(
         file_path: str,
         remove_duplicates: bool,
-        orient: Optional[str] = 'table') -> pd.DataFrame:
+        orient: Optional[str] = 'table',
+        columns: Optional[List[str]] = None) -> pd.DataFrame:
+    if file_path.endswith('.parquet'):
+        return read_parquet_dataframe(
+            file_path=file_path,
+            remove_duplicates=remove_duplicates,
+            columns=columns
+        )
     if file_path.endswith('.jsonl'):
         dataframe = pd.read_json(
             path_or_buf=file_path,
@@ -51,9 +296,164 @@ def read_json_dataframe(
         )
     if remove_duplicates:
         dataframe = dataframe.drop_duplicates(subset='id')
+    if columns:
+        dataframe = dataframe[columns]
+    return dataframe
+
+
+def _check_pyarrow_installed():
+    if pa is None:
+        raise ImportError('pyarrow is required to read and write parquet datasets')
+
+
+def is_embeddings_column(dataframe: pd.DataFrame, column: str) -> bool:
+    return column.endswith('_embeddings') and dataframe[column].dtype == object
+
+
+def write_parquet_dataframe(
+        dataframe: pd.DataFrame,
+        file_path: str,
+        embeddings_columns: Optional[List[str]] = None) -> None:
+    """
+    Write a dataframe of tweets to a parquet file. Embeddings columns are
+    stored as fixed-size float32 lists, other columns holding dicts or lists
+    (entities, public_metrics, referenced_tweets...) are stored as json text,
+    all their non-null values included, and decoded back on read
+    """
+    _check_pyarrow_installed()
+    if embeddings_columns is None:
+        embeddings_columns = [
+            column for column in dataframe.columns
+            if is_embeddings_column(dataframe, column)
+        ]
+    json_columns = []
+    scalar_dataframe = dataframe.drop(columns=embeddings_columns)
+    for column in scalar_dataframe.columns:
+        if scalar_dataframe[column].dtype == object and scalar_dataframe[column].map(
+                lambda x: isinstance(x, (dict, list))).any():
+            scalar_dataframe[column] = scalar_dataframe[column].map(
+                lambda x: None if x is None or (isinstance(x, float) and x != x) else json_dumps(x))
+            json_columns.append(column)
+    table = pa.Table.from_pandas(scalar_dataframe)
+    for column in embeddings_columns:
+        # tweets without embeddings (NaN or None) are stored as null lists, in
+        # a variable-size list column since pyarrow cannot read back null
+        # fixed-size lists
+        embeddings = [
+            embedding if isinstance(embedding, (list, np.ndarray)) else None
+            for embedding in dataframe[column].to_list()
+        ]
+        if any(embedding is None for embedding in embeddings):
+            embeddings_type = pa.list_(pa.float32())
+        else:
+            embeddings_type = pa.list_(pa.float32(), len(embeddings[0]) if embeddings else 0)
+        table = table.add_column(
+            list(dataframe.columns).index(column),
+            pa.field(column, embeddings_type),
+            pa.array(embeddings, type=embeddings_type)
+        )
+    metadata = dict(table.schema.metadata or {})
+    metadata[PARQUET_JSON_COLUMNS_KEY] = json.dumps(json_columns).encode('utf-8')
+    pq.write_table(table.replace_schema_metadata(metadata), file_path)
+
+
+def read_parquet_dataframe(
+        file_path: str,
+        remove_duplicates: bool,
+        columns: Optional[List[str]] = None,
+        filters: Optional[List[Tuple]] = None) -> pd.DataFrame:
+    """
+    Read a dataframe written by write_parquet_dataframe, only the requested
+    columns and the row groups matching the filters are read from disk
+    (filters use the pyarrow syntax, e.g. [('lang', '=', 'ja')])
+    """
+    _check_pyarrow_installed()
+    read_columns = columns
+    if remove_duplicates and columns is not None and 'id' not in columns:
+        read_columns = list(columns) + ['id']
+    table = pq.read_table(file_path, columns=read_columns, filters=filters)
+    json_columns = json.loads(
+        (table.schema.metadata or {}).get(PARQUET_JSON_COLUMNS_KEY, b'[]'))
+    dataframe = table.to_pandas()
+    for column in json_columns:
+        if column in dataframe.columns:
+            dataframe[column] = dataframe[column].map(
+                lambda x: json_loads(x) if isinstance(x, str) else x)
+    if remove_duplicates:
+        dataframe = dataframe.drop_duplicates(subset='id')
+        if read_columns is not columns:
+            dataframe = dataframe.drop(columns='id')
     return dataframe
 
 
+def write_dataframe(dataframe: pd.DataFrame, file_path: str) -> None:
+    """
+    Write a dataframe to parquet or to json (orient='table') depending on the extension
+    """
+    if file_path.endswith('.parquet'):
+        write_parquet_dataframe(dataframe, file_path)
+    else:
+        dataframe.to_json(file_path, orient='table')
+
+
+def convert_json_dataset_to_parquet(
+        json_path: str,
+        parquet_path: Optional[str] = None,
+        orient: Optional[str] = 'table') -> str:
+    """
+    Convert an existing json dataset (orient='table' or jsonl) to parquet
+    """
+    if not parquet_path:
+        parquet_path = os.path.splitext(json_path)[0] + '.parquet'
+    dataframe = read_json_dataframe(
+        file_path=json_path,
+        remove_duplicates=False,
+        orient=orient
+    )
+    write_parquet_dataframe(dataframe, parquet_path)
+    return parquet_path
+
+
+def embeddings_ids_path(matrix_path: str) -> str:
+    return os.path.splitext(matrix_path)[0] + '_ids.txt'
+
+
+def write_embeddings_matrix(
+        dataframe: pd.DataFrame,
+        embeddings_column: str,
+        matrix_path: str) -> None:
+    """
+    Persist an embeddings column as a float32 .npy matrix, with the tweet ids
+    of its rows in a txt file next to it. Rows are written one at a time in a
+    memory-mapped file, so the full float64 matrix is never built
+    """
+    embeddings = dataframe[embeddings_column]
+    matrix = np.lib.format.open_memmap(
+        matrix_path,
+        mode='w+',
+        dtype=np.float32,
+        shape=(len(embeddings), len(embeddings.iloc[0]))
+    )
+    for row, embedding in enumerate(embeddings):
+        matrix[row] = embedding
+    matrix.flush()
+    with open(embeddings_ids_path(matrix_path), 'w') as ids_file:
+        for tweet_id in dataframe['id']:
+            ids_file.write(f'{tweet_id}\n')
+
+
+def read_embeddings_matrix(
+        matrix_path: str,
+        mmap_mode: Optional[str] = 'r') -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the tweet ids and the memory-mapped embeddings matrix written by
+    write_embeddings_matrix
+    """
+    ids = np.array(read_txt_list(embeddings_ids_path(matrix_path)))
+    matrix = np.load(matrix_path, mmap_mode=mmap_mode)
+    return ids, matrix
+
+
 def read_prompt_file(
         file_path: str,
         task: str,
@@ -62,31 +462,38 @@ def read_prompt_file(
         prompt_dict = json.loads(prompt_file.read())
     task_dict = prompt_dict.get(task)
     if version == 'latest':
-        selected_prompt = task_dict.get(max(task_dict.keys()))
-    else:
-        selected_prompt = task_dict.get(version)
-    return selected_prompt
+        version = max(task_dict.keys())
+    selected_prompt = task_dict.get(version)
+    if selected_prompt is None:
+        return None
+    return dict(selected_prompt, version=version)
 
 
 def read_corpus_list(data_path: str):
     tweets = []
     for file_name in os.listdir(data_path):
         if file_name.endswith('.jsonl'):
-            with open(os.path.join(data_path, file_name), 'r') as data_file:
-                for tweet in data_file.readlines():
-                    tweets.append(json.loads(tweet))
+            tweets.extend(read_jsonl_generator(os.path.join(data_path, file_name)))
     return tweets
 
 
 def read_txt_list(file_path: str):
     file_list = []
     with open(file_path, 'r') as input_file:
-        for line in input_file.readlines():
+        for line in input_file:
             file_list.append(line.strip())
     return file_list
 
 
-def select_tweets_from_ids_in_corpus(data_path: str, tweet_ids: List[int]):
+def select_tweets_from_ids_in_corpus(data_path: str, tweet_ids: List[int], tweet_index=None):
+    """
+    Select tweets by id, by scanning the corpus or, with a TweetIndex
+    (utils.tweet_index), by reading only their lines after updating the index
+    """
+    if tweet_index is not None:
+        tweet_index.update(data_path)
+        return tweet_index.get_tweets(tweet_ids, jsonl_file_paths(data_path))
+    tweet_ids = set(tweet_ids)
     tweets = []
     for tweet in read_corpus_generator(data_path):
         if tweet.get('id') in tweet_ids:
@@ -94,12 +501,8 @@ def select_tweets_from_ids_in_corpus(data_path: str, tweet_ids: List[int]):
     return tweets
 
 
-def select_tweets_from_ids_in_jsonl(jsonl_path: str, tweet_ids: List[int]):
-    tweets = []
-    for tweet in read_jsonl_generator(jsonl_path):
-        if tweet.get('id') in tweet_ids:
-            tweets.append(tweet)
-    return tweets
+def select_tweets_from_ids_in_jsonl(jsonl_path: str, tweet_ids: List[int], tweet_index=None):
+    return select_tweets_from_ids_in_corpus(jsonl_path, tweet_ids, tweet_index)
 
 
 def divide_corpus(data_path: str, output_path, n_folds: int):
@@ -109,7 +512,7 @@ def divide_corpus(data_path: str, output_path, n_folds: int):
     for index, chunk in enumerate(chunks):
         with open(os.path.join(output_path, f"sample_{index + 1}_octobre.jsonl"), "w") as output_file:
             for tweet in chunk:
-                output_file.write(json.dumps(tweet) + "\n")
+                output_file.write(json_dumps(tweet) + "\n")
 
 
 def merge_all_problematic_tweets(input_dir_path, output_file_path):
@@ -117,7 +520,7 @@ def merge_all_problematic_tweets(input_dir_path, output_file_path):
         for tweet in read_corpus_generator(input_dir_path):
             if tweet.get('flag') == 'problematic':
                 print(tweet.get('en_text'))
-                output_file.write(json.dumps(tweet) + "\n")
+                output_file.write(json_dumps(tweet) + "\n")
 
 
 def merge_corpus(input_dir_path, output_file_path):
@@ -129,7 +532,7 @@ def merge_corpus(input_dir_path, output_file_path):
                 tweets.update({tweet_id: tweet})
     with open(output_file_path, 'w') as output_file:
         for index, tweet in enumerate(tweets.values()):
-            output_file.write(json.dumps(tweet) + "\n")
+            output_file.write(json_dumps(tweet) + "\n")
             print(index)
 
 
@@ -164,7 +567,7 @@ def read_users_csv(user_csv_path: str):
 def write_tweets_to_jsonl(output_path: str, tweets: List[Dict]):
     with open(output_path, 'w') as output_file:
         for tweet in tqdm(tweets):
-            output_file.write(json.dumps(tweet) + "\n")
+            output_file.write(json_dumps(tweet) + "\n")
 
 
 def write_tweets_to_csv(output_path: str, tweets: List[Dict]):
@@ -1,22 +1,28 @@
 import datetime
-import json
+import heapq
 import logging
 import os
 import re
-from typing import Callable
+from functools import partial
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import pandas
 import pandas as pd
 from tqdm import tqdm
 
 from utils import converters
+from utils.dedup import IdDeduplicator
 from utils.file_utils import (
     read_jsonl_generator,
+    read_jsonl_lines,
     write_tweets_to_jsonl,
-    select_tweets_from_ids_in_jsonl,
-    read_jsonl_list, write_tweets_to_csv
+    read_jsonl_list, write_tweets_to_csv,
+    json_dumps,
+    json_loads
 )
+from utils.parallel import map_ordered
 from utils.tweet_utils import is_retweet
+from utils.user_index import UserIndex
 
 
 def find_real_id_in_dataframe(stupid_id: str, user_data: pd.DataFrame):
@@ -40,140 +46,277 @@ def find_real_id_in_dataframe(stupid_id: str, user_data: pd.DataFrame):
             return str_id
 
 
+JSONL_CHUNK_SIZE = 200_000
+LARGE_FILE_SIZE_GB = 1.6
+LOW_TIMESTAMP = datetime.datetime(
+    year=2017, month=10, day=1, hour=0, minute=0, second=0, tzinfo=datetime.timezone.utc)
+HIGH_TIMESTAMP = datetime.datetime(
+    year=2019, month=10, day=31, hour=23, minute=59, second=59, tzinfo=datetime.timezone.utc)
+
+
 def is_most_ancient_data(entry):
-    low_timestamp = datetime.datetime(
-        year=2017, month=10, day=1, hour=0, minute=0, second=0, tzinfo=datetime.timezone.utc)
-    return entry['created_at'] < low_timestamp
+    return entry['created_at'] < LOW_TIMESTAMP
 
 
 def is_middle_data(entry):
-    low_timestamp = datetime.datetime(
-        year=2017, month=10, day=1, hour=0, minute=0, second=0, tzinfo=datetime.timezone.utc)
-    high_timestamp = datetime.datetime(
-        year=2019, month=10, day=31, hour=23, minute=59, second=59, tzinfo=datetime.timezone.utc)
-    return (entry['created_at'] > low_timestamp) & (entry['created_at'] < high_timestamp)
+    return (entry['created_at'] > LOW_TIMESTAMP) & (entry['created_at'] < HIGH_TIMESTAMP)
 
 
 def is_most_recent_data(entry):
-    high_timestamp = datetime.datetime(
-        year=2019, month=10, day=31, hour=23, minute=59, second=59, tzinfo=datetime.timezone.utc)
-    return entry['created_at'] > high_timestamp
+    return entry['created_at'] > HIGH_TIMESTAMP
 
 
-def divide_corpus_into_3_periods(tweet_dir_path: str, corpora_root: str):
-    make_corpora_from_tweet_dir(
-        tweet_dir_path=tweet_dir_path,
-        final_corpus_root=os.path.join(corpora_root, 'JAPAN_2016-sept-2017'),
-        filter_function=is_most_ancient_data
-    )
-    make_corpora_from_tweet_dir(
+def divide_corpus_into_3_periods(
+        tweet_dir_path: str,
+        corpora_root: str,
+        dedup_index_path: str = None):
+    route_tweet_dir_into_corpora(
         tweet_dir_path=tweet_dir_path,
-        final_corpus_root=os.path.join(corpora_root, 'JAPAN_oct-2017-oct-2019'),
-        filter_function=is_middle_data
+        corpora={
+            os.path.join(corpora_root, 'JAPAN_2016-sept-2017'): is_most_ancient_data,
+            os.path.join(corpora_root, 'JAPAN_oct-2017-oct-2019'): is_middle_data,
+            os.path.join(corpora_root, 'JAPAN_nov-2019-2022'): is_most_recent_data
+        },
+        dedup_index_path=dedup_index_path
     )
-    make_corpora_from_tweet_dir(
+
+
+def make_corpora_from_tweet_dir(
+        tweet_dir_path: str,
+        final_corpus_root: str,
+        filter_function: Callable,
+        dedup_index_path: str = None):
+    route_tweet_dir_into_corpora(
         tweet_dir_path=tweet_dir_path,
-        final_corpus_root=os.path.join(corpora_root, 'JAPAN_nov-2019-2022'),
-        filter_function=is_most_recent_data
+        corpora={final_corpus_root: filter_function},
+        dedup_index_path=dedup_index_path
     )
 
 
-def make_corpora_from_tweet_dir(tweet_dir_path: str, final_corpus_root: str, filter_function: Callable):
-    dataframe = pandas.DataFrame
+def route_tweet_dir_into_corpora(
+        tweet_dir_path: str,
+        corpora: Dict[str, Callable],
+        dedup_index_path: str = None,
+        chunk_size: int = JSONL_CHUNK_SIZE):
+    """
+    Read every jsonl file of tweet_dir_path once and send its tweets to each
+    corpus (final corpus root -> filter function) whose filter keeps them.
+    Filter functions are applied to the whole dataframe of a file and return a
+    boolean mask (e.g. is_middle_data). Duplicated ids are dropped per corpus
+    with a running id set, or an on-disk index per corpus with dedup_index_path.
+    Files are read chunk_size rows at a time, so that files of any size are
+    processed, the rows read from files over LARGE_FILE_SIZE_GB are summarized
+    """
+    corpus_rows = {corpus_root: 0 for corpus_root in corpora}
+    written_paths = {corpus_root: set() for corpus_root in corpora}
+    for corpus_root in corpora:
+        if not os.path.exists(corpus_root):
+            try:
+                os.makedirs(corpus_root)
+            except OSError as error:
+                logging.error(error)
+    deduplicators = {
+        corpus_root: IdDeduplicator(
+            index_path=corpus_dedup_index_path(dedup_index_path, corpus_root) if dedup_index_path else None)
+        for corpus_root in corpora
+    }
+    oversized_file_rows = {}
     for root, dirs, files in os.walk(tweet_dir_path):
         logging.warning(msg=f'PROCESSING ROOT DIR {root}')
         for filename in tqdm(files):
             if filename.endswith('.jsonl'):
-                file_size = os.path.getsize(os.path.join(root, filename))/(1 << 30)
-                if file_size > 1.6:
-                    pass
-                    logging.error(msg=f'NOT PROCESSING FILE {filename} BECAUSE OF FILE SIZE {file_size}')
+                file_path = os.path.join(root, filename)
+                file_size = os.path.getsize(file_path)/(1 << 30)
+                logging.warning(msg=f'Processing file ---> {filename}')
+                file_rows = 0
+                with pandas.read_json(file_path, orient='records', lines=True, chunksize=chunk_size) as reader:
+                    for file_dataframe in reader:
+                        file_rows += len(file_dataframe)
+                        for corpus_root, filter_function in corpora.items():
+                            filtered_tweets = file_dataframe.loc[filter_function(file_dataframe)]
+                            if filtered_tweets.empty:
+                                continue
+                            filtered_tweets = filtered_tweets.loc[deduplicators[corpus_root].keep_mask(
+                                filtered_tweets['id'], file_path)]
+                            if filtered_tweets.empty:
+                                continue
+                            write_dataframe_into_month_jsonl(
+                                filtered_tweets, corpus_root, written_paths=written_paths[corpus_root])
+                            corpus_rows[corpus_root] += len(filtered_tweets)
+                        del file_dataframe
+                for corpus_root, rows in corpus_rows.items():
+                    logging.warning(f'Number of rows for {corpus_root} : {rows}')
+                if file_size > LARGE_FILE_SIZE_GB:
+                    oversized_file_rows[file_path] = file_rows
+    for file_path, file_rows in oversized_file_rows.items():
+        logging.warning(f'{file_rows} rows read in chunks from oversized file {file_path}')
+    for deduplicator in deduplicators.values():
+        deduplicator.report()
+        deduplicator.close()
+
+
+def corpus_dedup_index_path(dedup_index_path: str, corpus_root: str) -> str:
+    base, extension = os.path.splitext(dedup_index_path)
+    return f'{base}_{os.path.basename(os.path.normpath(corpus_root))}{extension}'
+
+
+def write_dataframe_into_month_jsonl(
+        dataframe: pandas.DataFrame,
+        output_root_dir: str,
+        num_workers: int = 1,
+        append: bool = False,
+        written_paths: Optional[Set[str]] = None):
+    """
+    Write the tweets of a dataframe into one jsonl file per month of
+    created_at, in a single groupby over the years and months present in the
+    data (tweets without a date are skipped). Shards are written by
+    num_workers threads, and appended to existing month files instead of
+    overwriting them with append.
+    written_paths collects the files written by successive calls (e.g. per
+    chunk), which are then appended to while other files are overwritten
+    """
+    dataframe = dataframe[dataframe['created_at'].notna()]
+    created_at = dataframe['created_at']
+    shards = [
+        (int(year), int(month), month_dataframe)
+        for (year, month), month_dataframe in dataframe.groupby(
+            [created_at.dt.year, created_at.dt.month], sort=True)
+    ]
+    map_ordered(
+        partial(_write_month_shard, output_root_dir=output_root_dir, append=append,
+                written_paths=written_paths),
+        shards,
+        num_workers,
+        use_threads=True
+    )
+
+
+def _write_month_shard(
+        shard: Tuple[int, int, pandas.DataFrame],
+        output_root_dir: str,
+        append: bool,
+        written_paths: Optional[Set[str]] = None):
+    year, month, month_dataframe = shard
+    file_path = os.path.join(
+        output_root_dir, f'{year}-{month:02d}-{converters.month_int_to_str[month]}.jsonl')
+    if written_paths is not None:
+        append = append or file_path in written_paths
+        written_paths.add(file_path)
+    if not append or not os.path.exists(file_path):
+        month_dataframe.to_json(file_path, orient='records', date_format='iso', lines=True)
+        return
+    lines = month_dataframe.to_json(orient='records', date_format='iso', lines=True)
+    with open(file_path, 'rb+') as month_file:
+        month_file.seek(0, os.SEEK_END)
+        if month_file.tell() > 0:
+            month_file.seek(-1, os.SEEK_END)
+            if month_file.read(1) != b'\n':
+                month_file.write(b'\n')
+        month_file.write(lines.encode('utf-8'))
+        if not lines.endswith('\n'):
+            month_file.write(b'\n')
+
+
+NETWORK_STUDY_METRICS = ['reply_count', 'retweet_count', 'quote_count', 'like_count']
+
+
+def select_network_study_tweets(
+        jsonl_path: str,
+        threshold: int = 20,
+        max_tweets_per_metric: int = 20) -> List[Dict]:
+    """
+    Single pass over a month file selecting, for every metric, the first
+    max_tweets_per_metric tweets (in file order, retweets excluded) among those
+    having one of the threshold highest values of the metric. Each metric keeps
+    a min-heap of its top values, and only the first tweets of each of them
+    """
+    top_values = {metric_key: [] for metric_key in NETWORK_STUDY_METRICS}
+    candidates = {metric_key: {} for metric_key in NETWORK_STUDY_METRICS}
+    for line_number, (line, tweet) in enumerate(read_jsonl_lines(
+            jsonl_path, fields=['id', 'public_metrics', 'referenced_tweets'])):
+        if is_retweet(tweet):
+            continue
+        public_metrics = tweet.get('public_metrics')
+        full_tweet = None
+        for metric_key in NETWORK_STUDY_METRICS:
+            metric_count = public_metrics.get(metric_key)
+            if not metric_count:
+                continue
+            heap = top_values[metric_key]
+            metric_candidates = candidates[metric_key]
+            if metric_count not in metric_candidates:
+                if len(heap) < threshold:
+                    heapq.heappush(heap, metric_count)
+                elif heap and metric_count > heap[0]:
+                    del metric_candidates[heapq.heapreplace(heap, metric_count)]
                 else:
-                    logging.warning(msg=f'Processing file ---> {filename}')
-                    file_dataframe = pandas.read_json(os.path.join(root, filename), orient='records', lines=True)
-                    filtered_tweets = file_dataframe[file_dataframe.apply(lambda x: filter_function(x), axis=1)]
-                    del file_dataframe
-                    if dataframe.empty:
-                        dataframe = filtered_tweets
-                    else:
-                        dataframe = pd.concat([dataframe, filtered_tweets])
-                    logging.warning(f'Number of rows in Dataframe : {dataframe.shape[0]}')
-                    dataframe = dataframe.drop_duplicates(subset='id')
-                    logging.warning(f'Number of rows in Dataframe after filtering : {dataframe.shape[0]}')
-    if not os.path.exists(final_corpus_root):
-        try:
-            os.makedirs(final_corpus_root)
-        except OSError as error:
-            logging.error(error)
-    write_dataframe_into_month_jsonl(dataframe, final_corpus_root)
-
-
-def write_dataframe_into_month_jsonl(dataframe: pandas.DataFrame, output_root_dir: str):
-    for year in range(2016, 2024):
-        year_dataframe = dataframe[dataframe.apply(
-            lambda x: x['created_at'].year == year, axis=1)]
-        if not year_dataframe.empty:
-            for month in range(1, 13):
-                month_dataframe = year_dataframe[year_dataframe.apply(
-                    lambda x: x['created_at'].month == month, axis=1)]
-                month_str = converters.month_int_to_str[month]
-                file_name = f'{year}-{month:02d}-{month_str}.jsonl'
-                if not month_dataframe.empty:
-                    month_dataframe.to_json(
-                        os.path.join(output_root_dir, file_name),
-                        orient='records',
-                        date_format='iso',
-                        lines=True
-                    )
+                    continue
+                metric_candidates[metric_count] = []
+            if len(metric_candidates[metric_count]) < max_tweets_per_metric:
+                if full_tweet is None:
+                    full_tweet = json_loads(line)
+                metric_candidates[metric_count].append((line_number, full_tweet))
+    month_tweets = []
+    for metric_key in NETWORK_STUDY_METRICS:
+        selected = sorted(
+            (candidate for value_candidates in candidates[metric_key].values()
+             for candidate in value_candidates),
+            key=lambda candidate: candidate[0]
+        )
+        month_tweets.extend(
+            dict(tweet, source_inclusion=metric_key)
+            for _, tweet in selected[:max_tweets_per_metric])
+    return month_tweets
+
+
+def _format_month_for_network_study(
+        file: str,
+        tweet_dir_path: str,
+        output_dir_path: str,
+        threshold: int) -> None:
+    month_tweets = select_network_study_tweets(os.path.join(tweet_dir_path, file), threshold)
+    write_tweets_to_jsonl(os.path.join(output_dir_path, file), month_tweets)
 
 
 def format_dataset_for_network_study(
         tweet_dir_path: str,
         output_dir_path: str,
-        threshold: int = 20):
+        threshold: int = 20,
+        num_workers: int = 1):
     if output_dir_path == tweet_dir_path:
         raise FileExistsError
-    for file in tqdm(os.listdir(tweet_dir_path)):
-        input_jsonl_path = os.path.join(tweet_dir_path, file)
-        month_tweets = []
-        for metric_key in ['reply_count', 'retweet_count', 'quote_count', 'like_count']:
-            count_dict = {}
-            for tweet in read_jsonl_generator(input_jsonl_path):
-                if not is_retweet(tweet):
-                    metric_count = tweet.get('public_metrics').get(metric_key)
-                    if metric_count:
-                        count_dict.update({
-                            metric_count: count_dict.get(metric_count, []) + [tweet.get('id')]})
-            count_dict = {key: value for key, value in
-                          sorted(count_dict.items(), key=lambda item: item[0], reverse=True)}
-            sub_dict = dict(list(count_dict.items())[:threshold])
-            retrieved_tweets = select_tweets_from_ids_in_jsonl(
-                jsonl_path=input_jsonl_path,
-                tweet_ids=[item for sublist in sub_dict.values() for item in sublist])
-            for tweet in retrieved_tweets:
-                tweet.update({'source_inclusion': metric_key})
-            month_tweets.extend(retrieved_tweets[0:20])
-        write_tweets_to_jsonl(os.path.join(output_dir_path, file), month_tweets)
+    map_ordered(
+        partial(
+            _format_month_for_network_study,
+            tweet_dir_path=tweet_dir_path,
+            output_dir_path=output_dir_path,
+            threshold=threshold),
+        tqdm(os.listdir(tweet_dir_path)),
+        num_workers
+    )
 
 
 def format_dataset_to_include_user_info(
-        input_data_path: str, users_data_path: str, output_data_path: str):
-    users_data = read_jsonl_list(users_data_path)
+        input_data_path: str,
+        users_data_path: str,
+        output_data_path: str,
+        index_path: str = None):
+    user_index = UserIndex.from_jsonl(users_data_path, index_path=index_path)
     for file_name in os.listdir(input_data_path):
         if file_name.endswith('.jsonl'):
             with open(os.path.join(output_data_path, file_name), 'w+') as output_file:
                 for tweet in read_jsonl_generator(os.path.join(input_data_path, file_name)):
                     user_id = tweet.get('author_id')
-                    user_data = [user_data for user_data in users_data if user_data.get('id') == user_id]
+                    user_data = user_index.get(user_id)
                     if not user_data:
                         logging.warning(f'no user data for id : {user_id}')
-                    elif len(user_data) > 1:
+                    elif user_index.is_duplicate(user_id):
                         raise ValueError(f'more than one user data for id : {user_id}')
                     else:
-                        user_data = user_data[0]
                         for key, value in user_data.items():
                             tweet.update({f'user_{key}': value})
-                    output_file.write(json.dumps(tweet) + '\n')
+                    output_file.write(json_dumps(tweet) + '\n')
+    user_index.close()
 
 
 def flatten_jsonl_dataset(input_data_path: str, output_data_path: str):
@@ -189,7 +332,7 @@ def flatten_jsonl_dataset(input_data_path: str, output_data_path: str):
                         for metric_name, metric_count in user_public_metrics.items():
                             tweet.update({metric_name: metric_count})
                         tweet.pop('user_public_metrics')
-                    output_file.write(json.dumps(tweet) + '\n')
+                    output_file.write(json_dumps(tweet) + '\n')
 
 
 def format_jsonl_dataset_to_csv(input_path: str, output_path):
@@ -0,0 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+
+def map_ordered(
+        function: Callable,
+        arguments: Iterable,
+        num_workers: Optional[int] = 1,
+        use_threads: Optional[bool] = False) -> List:
+    """
+    Apply function to every argument, in a pool of worker processes (or
+    threads, for I/O bound work on shared data) when num_workers > 1, and
+    return the results in the order of the arguments
+    """
+    if not num_workers or num_workers <= 1:
+        return [function(argument) for argument in arguments]
+    executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    with executor_class(max_workers=num_workers) as executor:
+        return list(executor.map(function, arguments))
@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Callable, Mapping, Optional
+
+
+class RateLimitGovernor:
+    """
+    Thread-safe pacing of requests against an API window rate limit, driven by
+    the x-rate-limit-remaining / x-rate-limit-reset headers of the responses.
+    Every request is reserved with acquire(), which blocks the calling thread
+    while the window is exhausted, so that concurrent workers never send more
+    requests than the remaining budget.
+    For clients that do not expose the response headers, requests_per_window
+    enforces a known limit (e.g. 300 requests per 15 minutes) on its own
+    """
+
+    def __init__(
+            self,
+            default_wait: Optional[float] = 60.0,
+            requests_per_window: Optional[int] = None,
+            window_seconds: Optional[float] = 900.0,
+            clock: Optional[Callable[[], float]] = time.time,
+            sleep: Optional[Callable[[float], None]] = time.sleep):
+        self.default_wait = default_wait
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.waited_seconds = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._reset_at = 0.0
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = self._clock()
+                if self._reset_at <= now:
+                    self._remaining = None
+                    if self.requests_per_window:
+                        self._remaining = self.requests_per_window
+                        self._reset_at = now + self.window_seconds
+                if self._remaining is None or self._remaining > 0:
+                    if self._remaining is not None:
+                        self._remaining -= 1
+                    return
+                delay = self._reset_at - now
+                self.waited_seconds += delay
+            self._sleep(delay)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """
+        Update the window from the rate limit headers of a response
+        """
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        with self._lock:
+            if reset is not None:
+                self._reset_at = max(self._reset_at, float(reset))
+            if remaining is not None:
+                remaining = int(remaining)
+                self._remaining = remaining if self._remaining is None else min(self._remaining, remaining)
+
+    def block_until_reset(self, headers: Mapping[str, str]) -> None:
+        """
+        Close the window after a 429 response, until its reset time (or for
+        default_wait seconds when the response has no reset header), and for
+        at least a second so that a stale reset time does not cause a retry loop
+        """
+        reset = headers.get('x-rate-limit-reset')
+        with self._lock:
+            now = self._clock()
+            self._remaining = 0
+            self._reset_at = max(
+                self._reset_at,
+                now + 1.0,
+                float(reset) if reset is not None else now + self.default_wait)
+
+
+class RequestBudget:
+    """
+    Thread-safe global budget of requests and tweets shared by concurrent
+    harvests, each request is taken from it before being sent
+    """
+
+    def __init__(self, max_requests: Optional[int] = None, max_tweets: Optional[int] = None):
+        self.max_requests = max_requests
+        self.max_tweets = max_tweets
+        self.requests = 0
+        self.tweets = 0
+        self._lock = threading.Lock()
+
+    def take_request(self) -> bool:
+        """
+        Reserve a request, return False once the budget is exhausted
+        """
+        with self._lock:
+            if self.max_requests is not None and self.requests >= self.max_requests:
+                return False
+            if self.max_tweets is not None and self.tweets >= self.max_tweets:
+                return False
+            self.requests += 1
+            return True
+
+    def add_tweets(self, count: int) -> None:
+        with self._lock:
+            self.tweets += count
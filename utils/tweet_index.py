@@ -0,0 +1,144 @@
+import logging
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils.file_utils import json_loads, json_project, jsonl_file_paths
+
+
+class TweetIndex:
+    """
+    Persistent index of the tweets of a corpus, mapping each tweet id to the
+    month file holding it and the byte offset and length of its line, so that
+    tweets can be read by id without scanning the corpus.
+    The size and modification time of every indexed file are stored with it,
+    update() only re-indexes the files that changed since they were indexed
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._connection = sqlite3.connect(index_path)
+        self._connection.execute('PRAGMA synchronous=OFF')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files (file_path TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS tweets (id TEXT, file_path TEXT, offset INTEGER, length INTEGER)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS tweets_id ON tweets (id)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS tweets_file ON tweets (file_path)')
+
+    def is_up_to_date(self, file_path: str) -> bool:
+        file_path = os.path.abspath(file_path)
+        row = self._connection.execute(
+            'SELECT size, mtime FROM files WHERE file_path = ?', (file_path,)).fetchone()
+        stat = os.stat(file_path)
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+
+    def add_file_entries(self, file_path: str, entries: Iterable[Tuple[str, int, int]]) -> None:
+        """
+        Replace the entries of a file by (id, offset, length) tuples computed
+        while it was written, e.g. by the cleaning pipeline
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self._connection:
+            self._connection.execute('DELETE FROM tweets WHERE file_path = ?', (file_path,))
+            self._connection.executemany(
+                'INSERT INTO tweets VALUES (?, ?, ?, ?)',
+                ((str(tweet_id), file_path, offset, length) for tweet_id, offset, length in entries))
+            self._connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                (file_path, stat.st_size, stat.st_mtime))
+
+    def index_file(self, file_path: str) -> None:
+        self.add_file_entries(file_path, scan_line_offsets(file_path))
+
+    def update(self, data_path: str) -> int:
+        """
+        Index the jsonl files of data_path (a file or a directory) that are new
+        or changed, forget the files that no longer exist, and return the number
+        of files indexed
+        """
+        indexed = 0
+        for file_path in jsonl_file_paths(data_path):
+            if not self.is_up_to_date(file_path):
+                self.index_file(file_path)
+                indexed += 1
+        if not os.path.isfile(data_path):
+            root = os.path.join(os.path.abspath(data_path), '')
+            with self._connection:
+                for (file_path,) in self._connection.execute(
+                        'SELECT file_path FROM files WHERE file_path LIKE ?', (root + '%',)).fetchall():
+                    if not os.path.exists(file_path):
+                        self._connection.execute('DELETE FROM tweets WHERE file_path = ?', (file_path,))
+                        self._connection.execute('DELETE FROM files WHERE file_path = ?', (file_path,))
+        return indexed
+
+    def get_tweets(self, tweet_ids: Iterable, file_paths: Optional[Iterable[str]] = None) -> List[Dict]:
+        """
+        Read the tweets with the given ids, seeking straight to their lines,
+        only from file_paths when given (e.g. the files of one corpus).
+        Tweets are returned in corpus order (file path, then position in the file)
+        """
+        with self._connection:
+            self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS wanted_ids (id TEXT PRIMARY KEY)')
+            self._connection.execute('DELETE FROM wanted_ids')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO wanted_ids VALUES (?)', ((str(tweet_id),) for tweet_id in tweet_ids))
+            query = (
+                'SELECT tweets.file_path, tweets.offset, tweets.length FROM tweets '
+                'JOIN wanted_ids ON tweets.id = wanted_ids.id '
+            )
+            if file_paths is not None:
+                self._connection.execute(
+                    'CREATE TEMP TABLE IF NOT EXISTS wanted_files (file_path TEXT PRIMARY KEY)')
+                self._connection.execute('DELETE FROM wanted_files')
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO wanted_files VALUES (?)',
+                    ((os.path.abspath(file_path),) for file_path in file_paths))
+                query += 'JOIN wanted_files ON tweets.file_path = wanted_files.file_path '
+            rows = self._connection.execute(query + 'ORDER BY tweets.file_path, tweets.offset').fetchall()
+        tweets = []
+        data_file = None
+        current_path = None
+        try:
+            for file_path, offset, length in rows:
+                if file_path != current_path:
+                    if data_file:
+                        data_file.close()
+                    data_file = open(file_path, 'rb')
+                    current_path = file_path
+                data_file.seek(offset)
+                tweets.append(json_loads(data_file.read(length).decode('utf-8')))
+        finally:
+            if data_file:
+                data_file.close()
+        return tweets
+
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+
+    def close(self) -> None:
+        if self._connection:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+
+def scan_line_offsets(file_path: str) -> Iterable[Tuple[str, int, int]]:
+    """
+    Yield the (id, offset, length) of every tweet line of a jsonl file
+    """
+    id_field = frozenset(['id'])
+    offset = 0
+    with open(file_path, 'rb') as data_file:
+        for line_number, raw_line in enumerate(data_file, start=1):
+            line = raw_line.strip()
+            if line:
+                try:
+                    tweet_id = json_project(line.decode('utf-8'), id_field).get('id')
+                except ValueError:
+                    logging.warning(f'not indexing corrupt line {line_number} in {file_path}')
+                    tweet_id = None
+                if tweet_id is not None:
+                    yield tweet_id, offset, len(raw_line)
+            offset += len(raw_line)
@@ -0,0 +1,103 @@
+import sqlite3
+from typing import Dict, Iterable, Iterator, Optional
+
+from utils.file_utils import read_jsonl_generator, json_loads, json_dumps
+
+
+class UserIndex:
+    """
+    User profiles keyed by user id, held in a dict or, for user tables too
+    large for memory, in an on-disk sqlite table (index_path) rebuilt on load.
+    The first profile of an id is kept, ids found more than once are
+    recorded in duplicate_ids
+    """
+
+    def __init__(self, index_path: Optional[str] = None):
+        self.index_path = index_path
+        self.duplicate_ids = set()
+        self._users = None
+        self._connection = None
+        if index_path:
+            self._connection = sqlite3.connect(index_path)
+            self._connection.execute('PRAGMA journal_mode=OFF')
+            self._connection.execute('PRAGMA synchronous=OFF')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data TEXT)')
+            self._connection.execute('DELETE FROM users')
+        else:
+            self._users = {}
+
+    @classmethod
+    def from_records(
+            cls,
+            records: Iterable[Dict],
+            key: Optional[str] = 'id',
+            index_path: Optional[str] = None) -> 'UserIndex':
+        user_index = cls(index_path=index_path)
+        for user_data in records:
+            user_index.add(user_data.get(key), user_data)
+        if user_index._connection:
+            user_index._connection.commit()
+        return user_index
+
+    @classmethod
+    def from_jsonl(
+            cls,
+            users_data_path: str,
+            key: Optional[str] = 'id',
+            index_path: Optional[str] = None) -> 'UserIndex':
+        return cls.from_records(read_jsonl_generator(users_data_path), key, index_path)
+
+    def add(self, user_id, user_data: Dict) -> bool:
+        """
+        Index a user profile, return False if the id was already indexed
+        """
+        user_id = str(user_id)
+        if self._users is not None:
+            if user_id in self._users:
+                self.duplicate_ids.add(user_id)
+                return False
+            self._users[user_id] = user_data
+            return True
+        cursor = self._connection.execute(
+            'INSERT OR IGNORE INTO users VALUES (?, ?)', (user_id, json_dumps(user_data)))
+        if cursor.rowcount == 0:
+            self.duplicate_ids.add(user_id)
+            return False
+        return True
+
+    def is_duplicate(self, user_id) -> bool:
+        return str(user_id) in self.duplicate_ids
+
+    def get(self, user_id) -> Optional[Dict]:
+        user_id = str(user_id)
+        if self._users is not None:
+            return self._users.get(user_id)
+        row = self._connection.execute(
+            'SELECT data FROM users WHERE id = ?', (user_id,)).fetchone()
+        return json_loads(row[0]) if row else None
+
+    def values(self) -> Iterator[Dict]:
+        if self._users is not None:
+            yield from self._users.values()
+        else:
+            for row in self._connection.execute('SELECT data FROM users'):
+                yield json_loads(row[0])
+
+    def __contains__(self, user_id) -> bool:
+        user_id = str(user_id)
+        if self._users is not None:
+            return user_id in self._users
+        return self._connection.execute(
+            'SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        if self._users is not None:
+            return len(self._users)
+        return self._connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def close(self) -> None:
+        if self._connection:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None